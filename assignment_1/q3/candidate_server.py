@@ -0,0 +1,172 @@
+"""
+Long-running candidate server that keeps the DB feature index resident.
+
+Clients send queries one per record and get back `q #` / `c #` lines:
+
+    f 0 1 1 0 ...        feature vector (spaces optional: f 0110...)
+    # / v .. / e ..      query graph, ended by the next record, a blank line or EOF
+"""
+
+import asyncio
+import contextlib
+import os
+import sys
+import numpy as np
+from typing import List
+from graph_utils import Graph
+from fsm import load_subgraphs
+import feature_extractor
+from feature_extractor import SubgraphMatcher
+from generate_candidates import FeatureIndex, load_or_build_index
+
+
+class QuerySession:
+
+    def __init__(self, index: FeatureIndex, subgraphs: List[Graph]):
+        self.index = index
+        self.matcher = SubgraphMatcher(subgraphs, feature_extractor.EXTRACT_MAX_STEPS,
+                                       feature_extractor.EXTRACT_MAX_SECONDS, undecided=False)
+        self.n_queries = 0
+        self.pending = None
+    
+    def feed(self, line: str) -> str:
+
+        line = line.strip()
+        
+        if line.startswith('v ') or line.startswith('e '):
+            if self.pending is None:
+                return "! graph record must start with '#'\n"
+            parts = line.split()
+            try:
+                if parts[0] == 'v':
+                    self.pending.add_node(int(parts[1]), int(parts[2]))
+                else:
+                    self.pending.add_edge(int(parts[1]), int(parts[2]), int(parts[3]))
+            except (IndexError, ValueError):
+                return f"! malformed line: {line}\n"
+            return ''
+        
+
+        out = self.close()
+        
+        if line.startswith('#'):
+            self.pending = Graph()
+        elif line.startswith('f'):
+            out += self._answer_vector(line[1:])
+        elif line:
+            out += f"! unknown record: {line}\n"
+        
+        return out
+    
+    def close(self) -> str:
+
+        graph, self.pending = self.pending, None
+        if graph is None or len(graph.nodes) == 0:
+            return ''
+        return self._answer(self.matcher.features(graph))
+    
+    def _answer_vector(self, text: str) -> str:
+
+        text = text.strip()
+        values = text.split() if ' ' in text else list(text)
+        try:
+            vec = np.array([int(v) for v in values], dtype=np.int8)
+        except ValueError:
+            return f"! malformed feature vector: {text}\n"
+        
+        if vec.shape[0] != self.index.postings.shape[0]:
+            return f"! expected {self.index.postings.shape[0]} features, got {vec.shape[0]}\n"
+        return self._answer(vec)
+    
+    def _answer(self, query_vec: np.ndarray) -> str:
+
+        q_id = self.n_queries
+        self.n_queries += 1
+        candidate_list = self.index.query(query_vec)
+        return f"q # {q_id}\nc # {' '.join(map(str, candidate_list))}\n"
+
+
+async def handle_client(reader, writer, index: FeatureIndex, subgraphs: List[Graph]):
+
+    session = QuerySession(index, subgraphs)
+    loop = asyncio.get_running_loop()
+    
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            
+
+            # Graph queries run VF2, so keep them off the event loop.
+            out = await loop.run_in_executor(None, session.feed, line.decode())
+            if out:
+                writer.write(out.encode())
+                await writer.drain()
+        
+        out = await loop.run_in_executor(None, session.close)
+        if out:
+            writer.write(out.encode())
+            await writer.drain()
+    
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_socket(socket_path: str, index: FeatureIndex, subgraphs: List[Graph]):
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    
+    server = await asyncio.start_unix_server(
+        lambda r, w: handle_client(r, w, index, subgraphs),
+        path=socket_path
+    )
+    print(f"Serving candidates on {socket_path}", file=sys.stderr)
+    
+    async with server:
+        await server.serve_forever()
+
+
+def serve_stdio(index: FeatureIndex, subgraphs: List[Graph]):
+
+    session = QuerySession(index, subgraphs)
+    
+    for line in sys.stdin:
+        out = session.feed(line)
+        if out:
+            sys.stdout.write(out)
+            sys.stdout.flush()
+    
+    sys.stdout.write(session.close())
+    sys.stdout.flush()
+
+
+def main(argv: List[str]):
+
+    if len(argv) not in (2, 3):
+        print("Usage: python generate_candidates.py --serve <path_database_graph_features> <path_discriminative_subgraphs> [<socket_path>]")
+        sys.exit(1)
+    
+    db_features_path = argv[0]
+    subgraphs_path = argv[1]
+    socket_path = argv[2] if len(argv) == 3 else None
+    
+
+    # stdout carries the protocol in stdio mode, so keep load chatter off it.
+    with contextlib.redirect_stdout(sys.stderr):
+        index = load_or_build_index(db_features_path)
+        subgraphs = load_subgraphs(subgraphs_path)
+    
+    if socket_path is None:
+        serve_stdio(index, subgraphs)
+    else:
+        try:
+            asyncio.run(serve_socket(socket_path, index, subgraphs))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
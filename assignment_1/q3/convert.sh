@@ -2,8 +2,8 @@
 
 
 
-if [ "$#" -ne 3 ]; then
-    echo "Usage: bash convert.sh <path_graphs> <path_discriminative_subgraphs> <path_features>"
+if [ "$#" -ne 3 ] && [ "$#" -ne 4 ]; then
+    echo "Usage: bash convert.sh <path_graphs> <path_discriminative_subgraphs> <path_features> [db|query]"
     exit 1
 fi
 
@@ -14,4 +14,4 @@ OUTPUT_PATH=$3
 
 source venv/bin/activate
 
-python3 -u convert_to_features.py "$GRAPHS_PATH" "$SUBGRAPHS_PATH" "$OUTPUT_PATH"
+python3 -u convert_to_features.py "$GRAPHS_PATH" "$SUBGRAPHS_PATH" "$OUTPUT_PATH" ${4:+"$4"}
@@ -1,35 +1,41 @@
 
 
 import sys
-from graph_utils import parse_graph_file, remove_duplicates
+from graph_store import open_store
 from fsm import load_subgraphs
+import feature_extractor
 from feature_extractor import extract_features, save_features
 
 
 def main():
-    if len(sys.argv) != 4:
-        print("Usage: python convert_to_features.py <path_graphs> <path_discriminative_subgraphs> <path_features>")
+    if len(sys.argv) not in (4, 5) or (len(sys.argv) == 5 and sys.argv[4] not in ('db', 'query')):
+        print("Usage: python convert_to_features.py <path_graphs> <path_discriminative_subgraphs> <path_features> [db|query]")
         sys.exit(1)
     
     graphs_path = sys.argv[1]
     subgraphs_path = sys.argv[2]
     output_path = sys.argv[3]
+    side = sys.argv[4] if len(sys.argv) == 5 else None
     
 
     
 
-    graphs = parse_graph_file(graphs_path)
-
-    
-
-    unique_graphs = remove_duplicates(graphs)
+    unique_graphs = open_store(graphs_path)
 
     
 
     subgraphs = load_subgraphs(subgraphs_path)
     
 
-    features = extract_features(unique_graphs, subgraphs)
+    # The VF2 budget is used only when the side is given: a pattern VF2
+    # cannot settle within it is kept for DB graphs and dropped for
+    # queries, so it can only widen the candidate sets. Without a side
+    # every test runs to completion.
+    if side is None:
+        features = extract_features(unique_graphs, subgraphs)
+    else:
+        features = extract_features(unique_graphs, subgraphs, feature_extractor.EXTRACT_MAX_STEPS,
+                                    feature_extractor.EXTRACT_MAX_SECONDS, undecided=(side == 'db'))
     
 
     save_features(features, output_path)
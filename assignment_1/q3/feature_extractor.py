@@ -1,128 +1,499 @@
 
+import os
+import shutil
+import time
 import networkx as nx
 import numpy as np
-from typing import List
-from graph_utils import Graph
-from fsm import load_subgraphs
+from collections import Counter, defaultdict
+from typing import Iterable, List, Optional, Tuple
+from graph_utils import Graph, CompactGraph, as_compact, label_adjacency
+from graph_store import GraphStore, scratch_dir, shared_store
+from fsm import load_subgraphs, PathPattern, extract_paths_from_graph, extract_star_keys
 
 
-def is_subgraph_isomorphic(pattern: Graph, target: Graph) -> bool:
-   
-    if len(pattern.nodes) > len(target.nodes):
-        return False
-    if len(pattern.edges) > len(target.edges):
-        return False
-    
+try:
+    import rustworkx as rx
+except ImportError:
+    rx = None
 
-    try:
-        import rustworkx as rx
-        from rustworkx import is_subgraph_isomorphic as rx_is_subgraph
-        
 
-        pattern_rx = rx.PyGraph()
-        target_rx = rx.PyGraph()
-        
+def _rx_label_match(a, b):
+    return a == b
 
-        pattern_node_map = {}
-        for node_id, label in pattern.nodes.items():
-            pattern_node_map[node_id] = pattern_rx.add_node(label)
-        
-        target_node_map = {}
-        for node_id, label in target.nodes.items():
-            target_node_map[node_id] = target_rx.add_node(label)
-        
 
-        for src, dst, label in pattern.edges:
-            pattern_rx.add_edge(pattern_node_map[src], pattern_node_map[dst], label)
-        
-        for src, dst, label in target.edges:
-            target_rx.add_edge(target_node_map[src], target_node_map[dst], label)
-        
+def _nx_label_match(a, b):
+    return a.get('label') == b.get('label')
+
+
+FILTER_STATS = Counter()
 
-        def node_match(n1, n2):
-            return n1 == n2
+
+# VF2 budgets, in label-matcher calls (about a microsecond each) and
+# seconds; None means unbounded. Steps keep results reproducible. Read at
+# call time by the callers that opt into a budget.
+EXTRACT_MAX_STEPS = 1_000_000
+EXTRACT_MAX_SECONDS = None
+VERIFY_MAX_STEPS = 1_000_000
+VERIFY_MAX_SECONDS = None
+
+
+class BudgetExceeded(Exception):
+    """Raised when a VF2 match runs out of its step or time budget."""
+
+
+class _MatchBudget:
+
+    # Shared by the node and edge matchers of one VF2 call: every label
+    # comparison is a step, and the clock is read every 1024 steps.
+    __slots__ = ('max_steps', 'deadline', 'steps')
+    
+    def __init__(self, max_steps: Optional[int], max_seconds: Optional[float]):
+        self.max_steps = max_steps
+        self.deadline = None if max_seconds is None else time.perf_counter() + max_seconds
+        self.steps = 0
+    
+    def tick(self) -> bool:
+        self.steps += 1
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise BudgetExceeded(f"VF2 gave up after {self.max_steps} steps")
+        if self.deadline is not None and not self.steps & 1023 and time.perf_counter() > self.deadline:
+            raise BudgetExceeded(f"VF2 gave up after {self.steps} steps on its time budget")
+        return True
+
+
+class GraphSignature:
+
+    # Label-level invariants that any monomorphic image must dominate.
+    __slots__ = ('n_nodes', 'n_edges', 'node_labels', 'edge_triples', 'degrees')
+    
+    def __init__(self, graph):
+        if isinstance(graph, CompactGraph):
+            nodes, labels, adjacency = label_adjacency(graph)
+            self.n_edges = graph.n_edges
+        else:
+            neighbor_maps = defaultdict(dict)
+            for src, dst, label in graph.edges:
+                if src != dst:
+                    neighbor_maps[src][dst] = label
+                    neighbor_maps[dst][src] = label
+            nodes, labels = graph.nodes, graph.nodes
+            adjacency = {n: list(nbrs.items()) for n, nbrs in neighbor_maps.items()}
+            self.n_edges = len(graph.edges)
         
-        def edge_match(e1, e2):
-            return e1 == e2
+        self.n_nodes = len(nodes)
+        self.node_labels = Counter(labels[n] for n in nodes)
         
-        return rx_is_subgraph(
-            target_rx, pattern_rx,
-            node_matcher=node_match,
-            edge_matcher=edge_match,
-            induced=False  
-        )
+        self.edge_triples = Counter()
+        degrees = defaultdict(list)
+        for node_id in nodes:
+            label = labels[node_id]
+            neighbors = adjacency.get(node_id, ()) if isinstance(adjacency, dict) else adjacency[node_id]
+            degrees[label].append(len(neighbors))
+            for neighbor, edge_label in neighbors:
+                if node_id < neighbor:
+                    other = labels[neighbor]
+                    lu, lv = (label, other) if label <= other else (other, label)
+                    self.edge_triples[(lu, edge_label, lv)] += 1
         
-    except ImportError:
-        pass
-    
+        self.degrees = {label: sorted(d, reverse=True) for label, d in degrees.items()}
+
+
+def graph_signature(graph: Graph, pin: bool = False) -> GraphSignature:
+
+    signature = getattr(graph, '_signature', None)
+    if signature is None:
+        signature = GraphSignature(graph)
+        if pin and isinstance(graph, Graph):
+            graph._signature = signature
+    return signature
+
+
+def _counter_contains(big: Counter, small: Counter) -> bool:
+    return all(big.get(key, 0) >= count for key, count in small.items())
+
 
-    pattern_nx = pattern.to_networkx()
-    target_nx = target.to_networkx()
+def prefilter_reject(pattern_sig: GraphSignature, target_sig: GraphSignature) -> Optional[str]:
+
+    # Returns the name of the first necessary condition the pair fails,
+    # or None when only a full VF2 match can decide.
+    if pattern_sig.n_nodes > target_sig.n_nodes or pattern_sig.n_edges > target_sig.n_edges:
+        return 'size'
+    if not _counter_contains(target_sig.node_labels, pattern_sig.node_labels):
+        return 'node_labels'
+    if not _counter_contains(target_sig.edge_triples, pattern_sig.edge_triples):
+        return 'edge_triples'
+    
+    for label, p_degrees in pattern_sig.degrees.items():
+        t_degrees = target_sig.degrees[label]
+        if any(p > t for p, t in zip(p_degrees, t_degrees)):
+            return 'degrees'
     
+    return None
+
+
+def print_filter_stats(stats: Counter = None):
+
+    stats = FILTER_STATS if stats is None else stats
+    calls = stats['calls']
+    if calls:
+        print(f"  Isomorphism calls: {calls}")
+        for name in ('size', 'node_labels', 'edge_triples', 'degrees'):
+            print(f"    rejected by {name:<13} {stats[name]:>10} ({stats[name]/calls*100:.1f}%)")
+        print(f"    reached VF2            {stats['vf2']:>10} ({stats['vf2']/calls*100:.1f}%)")
+        if stats['budget']:
+            print(f"    VF2 budget exhausted   {stats['budget']:>10}")
+    if stats['enumerated']:
+        print(f"  Answered by path/star enumeration: {stats['enumerated']}")
+    if stats['inferred']:
+        print(f"  Inferred from pattern lattice: {stats['inferred']}")
+
 
-    def node_match(n1, n2):
-        return n1.get('label') == n2.get('label')
+def compile_graph(graph, pin: bool = False):
+
+    # Backend representation of a Graph; pinned graphs keep it for reuse.
+    compiled = getattr(graph, '_compiled', None)
+    if compiled is not None:
+        return compiled
+    
+    if isinstance(graph, CompactGraph):
+        compiled = graph.to_rustworkx() if rx is not None else graph.to_networkx()
+    elif rx is not None:
+        compiled = rx.PyGraph()
+        node_map = {}
+        for node_id, label in graph.nodes.items():
+            node_map[node_id] = compiled.add_node(label)
+        compiled.add_edges_from([
+            (node_map[src], node_map[dst], label) for src, dst, label in graph.edges
+        ])
+    else:
+        compiled = graph.to_networkx()
     
+    if pin and isinstance(graph, Graph):
+        graph._compiled = compiled
+    return compiled
+
 
-    def edge_match(e1, e2):
-        return e1.get('label') == e2.get('label')
+def match_compiled(pattern_c, target_c, max_steps: Optional[int] = None,
+                   max_seconds: Optional[float] = None) -> bool:
+
+    # With a budget the label matchers count steps and raise
+    # BudgetExceeded once it is spent.
+    label_match = _rx_label_match if rx is not None else _nx_label_match
+    if max_steps is not None or max_seconds is not None:
+        budget = _MatchBudget(max_steps, max_seconds)
+        unbudgeted = label_match
+        label_match = lambda a, b: budget.tick() and unbudgeted(a, b)
+    
+    if rx is not None:
+        return rx.is_subgraph_isomorphic(
+            target_c, pattern_c,
+            node_matcher=label_match,
+            edge_matcher=label_match,
+            induced=False
+        )
     
 
     GM = nx.isomorphism.GraphMatcher(
-        target_nx,
-        pattern_nx,
-        node_match=node_match,
-        edge_match=edge_match
+        target_c,
+        pattern_c,
+        node_match=label_match,
+        edge_match=label_match
     )
+    return GM.subgraph_is_monomorphic()
+
+
+def is_subgraph_isomorphic(pattern: Graph, target: Graph, max_steps: Optional[int] = None,
+                           max_seconds: Optional[float] = None) -> bool:
+   
+    FILTER_STATS['calls'] += 1
+    rejected = prefilter_reject(graph_signature(pattern, pin=True), graph_signature(target, pin=True))
+    if rejected is not None:
+        FILTER_STATS[rejected] += 1
+        return False
+    
+    FILTER_STATS['vf2'] += 1
+    try:
+        return match_compiled(compile_graph(pattern, pin=True), compile_graph(target), max_steps, max_seconds)
+    except BudgetExceeded:
+        FILTER_STATS['budget'] += 1
+        raise
+
+
+def pattern_shape(graph: Graph):
+
+    # ('path', PathPattern) or ('star', star key) for the shapes the miner
+    # produces, None for anything that needs a general isomorphism test.
+    n_nodes = len(graph.nodes)
+    if n_nodes < 2 or len(graph.edges) != n_nodes - 1:
+        return None
     
+    adjacency = defaultdict(list)
+    for src, dst, label in graph.edges:
+        if src == dst or src not in graph.nodes or dst not in graph.nodes:
+            return None
+        adjacency[src].append((dst, label))
+        adjacency[dst].append((src, label))
+    if len(adjacency) != n_nodes:
+        return None
+    
+    degrees = {node: len(nbrs) for node, nbrs in adjacency.items()}
+    
+    if max(degrees.values()) <= 2:
+        start = min(node for node, d in degrees.items() if d == 1)
+        node_labels = [graph.nodes[start]]
+        edge_labels = []
+        prev, current = None, start
+        while True:
+            step = [(n, l) for n, l in adjacency[current] if n != prev]
+            if not step:
+                break
+            prev, (current, label) = current, step[0]
+            node_labels.append(graph.nodes[current])
+            edge_labels.append(label)
+        
+        if len(node_labels) != n_nodes:
+            return None
+        return 'path', PathPattern(tuple(node_labels), tuple(edge_labels)).canonical_form()
+    
+    centers = [node for node, d in degrees.items() if d == n_nodes - 1]
+    if len(centers) == 1:
+        center = centers[0]
+        leaves = tuple(sorted((label, graph.nodes[n]) for n, label in adjacency[center]))
+        return 'star', (graph.nodes[center], leaves)
+    
+    return None
 
-    return GM.subgraph_is_monomorphic()
 
+class SubgraphMatcher:
 
-def extract_features(graphs: List[Graph], subgraphs: List[Graph]) -> np.ndarray:
-  
-    n_graphs = len(graphs)
-    n_features = len(subgraphs)
+    # Path and star patterns are answered by one enumeration of the
+    # target's label paths and stars. The rest are compiled once and pinned;
+    # each target is compiled once and reused for every pattern. The
+    # containment lattice among the patterns lets one test settle others:
+    # an absent pattern rules out every super-pattern, a present one
+    # implies every sub-pattern.
+    #
+    # max_steps and max_seconds bound each VF2 test; the default is no
+    # budget. undecided is the outcome of a test that exhausts it. Only a
+    # false 1 on the DB side and a false 0 on the query side are safe, as
+    # either one just widens the candidate sets: use True for DB graphs and
+    # False for queries.
+    
+    REORDER_INTERVAL = 64
     
+    def __init__(self, patterns: List[Graph], max_steps: Optional[int] = None,
+                 max_seconds: Optional[float] = None, undecided: bool = True):
+        self.patterns = patterns
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.undecided = undecided
+        self.signatures = [graph_signature(p, pin=True) for p in patterns]
+        for pattern in patterns:
+            compile_graph(pattern, pin=True)
+        
+        self.path_keys = defaultdict(list)
+        self.star_keys = defaultdict(list)
+        for j, pattern in enumerate(patterns):
+            shape = pattern_shape(pattern)
+            if shape is not None and shape[0] == 'path':
+                self.path_keys[shape[1]].append(j)
+            elif shape is not None:
+                self.star_keys[shape[1]].append(j)
+        
+        self.max_path_length = max((len(p) for p in self.path_keys), default=0)
+        self.star_sizes = sorted({len(key[1]) for key in self.star_keys})
+        
+        n = len(patterns)
+        contains = np.zeros((n, n), dtype=bool)
+        for i in range(n):
+            for j in range(n):
+                if i != j and prefilter_reject(self.signatures[j], self.signatures[i]) is None:
+                    contains[i, j] = match_compiled(patterns[j]._compiled, patterns[i]._compiled)
+        
+        self.subs = [np.flatnonzero(contains[i]) for i in range(n)]
+        self.supers = [np.flatnonzero(contains[:, i]) for i in range(n)]
+        
+        self.enumerated = np.zeros(n, dtype=bool)
+        for indices in list(self.path_keys.values()) + list(self.star_keys.values()):
+            self.enumerated[indices] = True
+        self.tested = np.flatnonzero(~self.enumerated)
+        
+        self.n_seen = 0
+        self.present = np.zeros(n, dtype=np.int64)
+        self._reorder()
+    
+    def _reorder(self):
 
+        # Of the patterns left to VF2, test first those whose expected
+        # outcome settles the most others left to VF2, using the presence
+        # rates seen so far. Enumerated patterns are settled before the loop.
+        tested = self.tested
+        p = (self.present[tested] + 1) / (self.n_seen + 2)
+        n_subs = np.array([np.count_nonzero(~self.enumerated[self.subs[j]]) for j in tested])
+        n_supers = np.array([np.count_nonzero(~self.enumerated[self.supers[j]]) for j in tested])
+        self.order = tested[np.argsort(-(p * n_subs + (1 - p) * n_supers), kind='stable')]
     
-    try:
-        from joblib import Parallel, delayed
-        import multiprocessing
-        n_jobs = min(multiprocessing.cpu_count(), 8)  
+    def _enumerate(self, graph: Graph, state: np.ndarray):
 
+        graph = as_compact(graph)
+        
+        if self.path_keys:
+            paths = extract_paths_from_graph(graph, self.max_path_length)
+            for key, indices in self.path_keys.items():
+                state[indices] = key in paths
+        
+        if self.star_keys:
+            stars = extract_star_keys(graph, self.star_sizes)
+            for key, indices in self.star_keys.items():
+                state[indices] = key in stars
         
-        def extract_single_graph_features(graph, subgraphs):
-            """Extract binary features for a single graph."""
-            features = []
-            for subgraph in subgraphs:
-                if is_subgraph_isomorphic(subgraph, graph):
-                    features.append(1)
-                else:
-                    features.append(0)
-            return features
+        FILTER_STATS['enumerated'] += int(np.count_nonzero(state != -1))
         
+        # Enumerated outcomes settle the rest of the lattice too: an absent
+        # pattern rules out its super-patterns, a present one implies its
+        # sub-patterns.
+        for j in np.flatnonzero(self.enumerated):
+            implied = self.subs[j] if state[j] == 1 else self.supers[j]
+            if implied.size:
+                unknown = implied[state[implied] == -1]
+                FILTER_STATS['inferred'] += unknown.size
+                state[unknown] = state[j]
+    
+    def features(self, graph: Graph) -> np.ndarray:
 
-        results = Parallel(n_jobs=n_jobs, verbose=10)(
-            delayed(extract_single_graph_features)(graph, subgraphs) 
-            for graph in graphs
-        )
+        state = np.full(len(self.patterns), -1, dtype=np.int8)
+        target_sig = graph_signature(graph)
+        target_c = None
+        
+        if self.path_keys or self.star_keys:
+            self._enumerate(graph, state)
         
+        for j in self.order:
+            if state[j] != -1:
+                continue
+            
 
-        features = np.array(results, dtype=np.int8)
+            FILTER_STATS['calls'] += 1
+            rejected = prefilter_reject(self.signatures[j], target_sig)
+            if rejected is not None:
+                FILTER_STATS[rejected] += 1
+                present = False
+            else:
+                FILTER_STATS['vf2'] += 1
+                if target_c is None:
+                    target_c = compile_graph(graph)
+                try:
+                    present = match_compiled(self.patterns[j]._compiled, target_c,
+                                             self.max_steps, self.max_seconds)
+                except BudgetExceeded:
+                    FILTER_STATS['budget'] += 1
+                    present = self.undecided
+            
+            if present:
+                implied = self.subs[j]
+                state[j] = 1
+            else:
+                implied = self.supers[j]
+                state[j] = 0
+            
+            if implied.size:
+                unknown = implied[state[implied] == -1]
+                FILTER_STATS['inferred'] += unknown.size
+                state[unknown] = state[j]
+        
 
+        self.n_seen += 1
+        self.present += state
+        if self.n_seen % self.REORDER_INTERVAL == 0:
+            self._reorder()
         
-    except ImportError:
+        return state
+
+
+# Per-process extraction state, set once by _init_extract_worker.
+_WORKER = {}
+
+
+def _init_extract_worker(store: GraphStore, subgraphs: List[Graph], features,
+                         max_steps: Optional[int] = None, max_seconds: Optional[float] = None,
+                         undecided: bool = True):
+
+    # Pool initializer: each worker builds its matcher once and maps the
+    # shared output matrix, so tasks only carry a graph range.
+    if isinstance(features, str):
+        features = np.load(features, mmap_mode='r+')
+    _WORKER['store'] = store
+    _WORKER['matcher'] = SubgraphMatcher(subgraphs, max_steps, max_seconds, undecided)
+    _WORKER['features'] = features
+
+
+def _extract_into(bounds: Tuple[int, int]):
+
+    # Write the rows of graphs [start, end) into the shared matrix; only
+    # the range size and the filter counters travel back.
+    start, end = bounds
+    FILTER_STATS.clear()
+    matcher = _WORKER['matcher']
+    features = _WORKER['features']
+    for i, graph in enumerate(_WORKER['store'].range(start, end), start):
+        features[i] = matcher.features(graph)
+    return end - start, Counter(FILTER_STATS)
+
 
-        features = np.zeros((n_graphs, n_features), dtype=np.int8)
+EXTRACT_BATCH_SIZE = 256
+BATCHES_PER_WORKER = 4
+
+
+def extract_features(graphs: Iterable[Graph], subgraphs: List[Graph], max_steps: Optional[int] = None,
+                     max_seconds: Optional[float] = None, undecided: bool = True) -> np.ndarray:
+  
+    # The VF2 budget and undecided are passed to SubgraphMatcher; without
+    # a budget every test runs to completion. With one, undecided is True
+    # for DB graphs and False for query graphs.
+    n_features = len(subgraphs)
+    
+
+    import multiprocessing
+    n_jobs = multiprocessing.cpu_count()
+    
+    with shared_store(graphs) as store:
+        n_graphs = len(store)
         
-        for i, graph in enumerate(graphs):
-            if i % 50 == 0:
-                print(f"  Extracting features for graph {i}/{n_graphs}...")
-            
-            for j, subgraph in enumerate(subgraphs):
-                if is_subgraph_isomorphic(subgraph, graph):
-                    features[i, j] = 1
+
+        # A few large contiguous batches per worker, for load balance.
+        batch_size = max(EXTRACT_BATCH_SIZE, -(-n_graphs // (n_jobs * BATCHES_PER_WORKER)))
+        ranges = [(start, min(start + batch_size, n_graphs)) for start in range(0, n_graphs, batch_size)]
+        stats = Counter()
+        
+        if n_jobs == 1 or len(ranges) <= 1:
+            features = np.zeros((n_graphs, n_features), dtype=np.int8)
+            _init_extract_worker(store, subgraphs, features, max_steps, max_seconds, undecided)
+            for start, end in ranges:
+                stats.update(_extract_into((start, end))[1])
+                print(f"  Extracted {end}/{n_graphs} graphs")
+            _WORKER.clear()
+        
+        else:
+            tmp_dir = scratch_dir()
+            try:
+                features_path = os.path.join(tmp_dir, 'features.npy')
+                np.lib.format.open_memmap(
+                    features_path, mode='w+', dtype=np.int8, shape=(n_graphs, n_features)
+                ).flush()
+                
+                init_args = (store, subgraphs, features_path, max_steps, max_seconds, undecided)
+                with multiprocessing.Pool(n_jobs, _init_extract_worker, init_args) as pool:
+                    done = 0
+                    for count, batch_stats in pool.imap_unordered(_extract_into, ranges):
+                        done += count
+                        stats.update(batch_stats)
+                        print(f"  Extracted {done}/{n_graphs} graphs")
+                
+                features = np.array(np.load(features_path, mmap_mode='r'))
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    print_filter_stats(stats)
     
 
     
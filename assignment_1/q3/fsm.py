@@ -1,10 +1,239 @@
 
 
-import networkx as nx
+import contextlib
+import numpy as np
 from collections import defaultdict, Counter
-from typing import List, Set, Tuple, Dict, Optional
-from graph_utils import Graph
+from itertools import combinations
+from typing import List, Set, Tuple, Dict, Optional, Iterable
+from graph_utils import Graph, CompactGraph, as_compact, label_adjacency
+from graph_store import GraphStore, shared_store
 import pickle
+import random
+from heapq import heapify, heappop, heappush
+from array import array
+
+
+BLOCK_ELEMENTS = 1 << 22
+
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount_rows(bits: np.ndarray) -> np.ndarray:
+
+    # Set bits per row of a packed uint64 matrix.
+    if hasattr(np, 'bitwise_count'):
+        counts = np.bitwise_count(bits)
+    else:
+        counts = _BYTE_POPCOUNT[np.ascontiguousarray(bits).view(np.uint8)]
+    return counts.sum(axis=-1, dtype=np.int64)
+
+
+class OccurrenceBits:
+
+    # Graph occurrences of many patterns as packed bit rows of one uint64
+    # matrix: bit g of row rows[pattern] is set when graph g contains the
+    # pattern. A row costs n_graphs / 8 bytes however dense it is.
+    
+    def __init__(self, n_graphs: int):
+        self.n_graphs = n_graphs
+        self.n_words = max(1, (n_graphs + 63) // 64)
+        self._bits = np.zeros((64, self.n_words), dtype=np.uint64)
+        self.rows = {}
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    @property
+    def bits(self) -> np.ndarray:
+        return self._bits[:len(self.rows)]
+    
+    def __contains__(self, pattern):
+        return pattern in self.rows
+    
+    def _row_indices(self, patterns: Iterable) -> np.ndarray:
+
+        # Rows of patterns, appending zero rows for new ones.
+        n_rows = len(self.rows)
+        row_idx = [self.rows.setdefault(pattern, len(self.rows)) for pattern in patterns]
+        
+        if len(self.rows) > len(self._bits):
+            capacity = max(len(self.rows), 2 * len(self._bits))
+            grown = np.zeros((capacity, self.n_words), dtype=np.uint64)
+            grown[:n_rows] = self._bits[:n_rows]
+            self._bits = grown
+        
+        return np.array(row_idx, dtype=np.int64)
+    
+    def extend(self, occurrences: Dict) -> None:
+
+        # Add a {pattern: graph indices} mapping; patterns already present
+        # have the new graphs OR-ed into their row.
+        if not occurrences:
+            return
+        
+        lengths = [len(graph_ids) for graph_ids in occurrences.values()]
+        row_idx = self._row_indices(occurrences)
+        cols = np.fromiter(
+            (g for graph_ids in occurrences.values() for g in graph_ids),
+            dtype=np.int64, count=sum(lengths)
+        )
+        self._set(np.repeat(row_idx, lengths), cols)
+    
+    def add(self, patterns: List, graph_ids) -> None:
+
+        # Set bit graph_ids[j] in the row of patterns[j], for every j.
+        if not len(patterns):
+            return
+        
+        self._set(self._row_indices(patterns), np.asarray(graph_ids, dtype=np.int64))
+    
+    def _set(self, rows: np.ndarray, cols: np.ndarray) -> None:
+
+        masks = np.left_shift(np.uint64(1), (cols & 63).astype(np.uint64))
+        np.bitwise_or.at(self._bits, (rows, cols >> 6), masks)
+    
+    def merge_range(self, other: 'OccurrenceBits', start: int, mapping: Dict) -> None:
+
+        # OR in other's rows, filed here under mapping[pattern] for each of
+        # other's patterns in mapping; other's graph 0 is graph start here.
+        # start is a multiple of 64 so the rows line up by word.
+        patterns = [p for p in mapping if p in other.rows]
+        if not patterns:
+            return
+        
+        row_idx = self._row_indices(mapping[p] for p in patterns)
+        other_idx = np.array([other.rows[p] for p in patterns], dtype=np.int64)
+        word = start // 64
+        self._bits[row_idx, word:word + other.n_words] |= other._bits[other_idx]
+    
+    def row(self, pattern) -> np.ndarray:
+
+        return self._bits[self.rows[pattern]]
+    
+    def get(self, pattern) -> Set[int]:
+
+        if pattern not in self.rows:
+            return set()
+        bits = np.unpackbits(self.row(pattern).view(np.uint8), bitorder='little')
+        return set(np.flatnonzero(bits[:self.n_graphs]).tolist())
+
+
+PATTERN_KINDS = ('path', 'tree', 'subgraph')
+
+
+def _pack_key(kind: int, values) -> bytes:
+
+    return bytes((kind,)) + array('q', values).tobytes()
+
+
+def _unpack_key(key: bytes) -> Tuple:
+
+    values = array('q')
+    values.frombytes(key[1:])
+    return tuple(values)
+
+
+def path_key(node_labels: Tuple, edge_labels: Tuple) -> bytes:
+
+    return _pack_key(0, node_labels + edge_labels)
+
+
+def tree_key(canonical: Tuple) -> bytes:
+
+    return _pack_key(1, canonical)
+
+
+def subgraph_key(code: Tuple) -> bytes:
+
+    return _pack_key(2, [value for edge in code for value in edge])
+
+
+def decode_pattern(key: bytes):
+
+    values = _unpack_key(key)
+    kind = PATTERN_KINDS[key[0]]
+    if kind == 'path':
+        n_edges = len(values) // 2
+        return PathPattern(values[:n_edges + 1], values[n_edges + 1:])
+    if kind == 'tree':
+        return decode_tree(values)
+    return SubgraphPattern(tuple(values[i:i + 5] for i in range(0, len(values), 5)))
+
+
+class PatternTable:
+
+    # Interning table for mined patterns: each compact key (kind byte plus
+    # int64 labels) gets a dense pattern id, and supports live in an array
+    # indexed by id. Pattern objects are only decoded from keys on demand.
+    
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.support = array('q')
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def add(self, key: bytes, support: int) -> int:
+
+        pid = self.ids.get(key)
+        if pid is None:
+            pid = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.support.append(support)
+        else:
+            self.support[pid] = support
+        return pid
+    
+    def kind(self, pid: int) -> str:
+
+        return PATTERN_KINDS[self.keys[pid][0]]
+    
+    def pattern(self, pid: int):
+
+        return decode_pattern(self.keys[pid])
+
+
+SKETCH_WIDTH = 1 << 20
+SKETCH_DEPTH = 4
+
+# Odd 64-bit multipliers, one per sketch row, for multiply-shift hashing.
+_SKETCH_MULTIPLIERS = np.array([
+    0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+    0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x94D049BB133111EB, 0xBF58476D1CE4E5B9,
+], dtype=np.uint64)
+
+
+class CountMinSketch:
+
+    # Approximate counts in depth rows of width counters: a key adds one to
+    # a counter per row and its estimate is the smallest of them, which can
+    # overcount through collisions but never undercounts.
+    
+    def __init__(self, width: int = SKETCH_WIDTH, depth: int = SKETCH_DEPTH):
+        if width & (width - 1) or not 0 < depth <= len(_SKETCH_MULTIPLIERS):
+            raise ValueError("sketch width must be a power of two and depth at most "
+                             f"{len(_SKETCH_MULTIPLIERS)}")
+        self.table = np.zeros((depth, width), dtype=np.int32)
+        self.shift = np.uint64(64 - (width.bit_length() - 1))
+    
+    def _columns(self, keys: List) -> np.ndarray:
+
+        hashes = np.fromiter((hash(key) for key in keys), dtype=np.int64, count=len(keys))
+        multipliers = _SKETCH_MULTIPLIERS[:len(self.table), None]
+        return (hashes.view(np.uint64)[None, :] * multipliers) >> self.shift
+    
+    def add(self, keys: List) -> None:
+
+        if not keys:
+            return
+        for row, columns in zip(self.table, self._columns(keys)):
+            np.add.at(row, columns, 1)
+    
+    def estimate(self, keys: List) -> np.ndarray:
+
+        rows = np.arange(len(self.table))[:, None]
+        return self.table[rows, self._columns(keys)].min(axis=0)
 
 
 class PathPattern:
@@ -66,6 +295,108 @@ class PathPattern:
         return self
 
 
+def _tree_centers(adjacency: Dict) -> List[int]:
+
+    # Strip leaves layer by layer; the last one or two nodes standing are
+    # the center of the tree.
+    remaining = set(adjacency)
+    degree = {node: len(adjacency[node]) for node in remaining}
+    layer = [node for node in remaining if degree[node] <= 1]
+    
+    while len(remaining) > 2 and layer:
+        next_layer = []
+        for leaf in layer:
+            remaining.discard(leaf)
+            for neighbor, _ in adjacency[leaf]:
+                if neighbor in remaining:
+                    degree[neighbor] -= 1
+                    if degree[neighbor] == 1:
+                        next_layer.append(neighbor)
+        layer = next_layer
+    
+    return sorted(remaining)
+
+
+def _tree_encode(labels, adjacency: Dict, node: int, parent: Optional[int]) -> Tuple[Tuple, List[int]]:
+
+    # AHU encoding, flattened: the node label, its child count, then each
+    # child as its edge label and encoding, children in sorted order. The
+    # counts make it decodable, so equal encodings mean isomorphic subtrees.
+    # Also returns the nodes in the preorder the encoding lists them, which
+    # is the numbering decode_tree gives them.
+    children = []
+    for child, edge_label in adjacency[node]:
+        if child != parent:
+            encoding, order = _tree_encode(labels, adjacency, child, node)
+            children.append(((edge_label,) + encoding, order))
+    children.sort()
+    
+    encoding = (labels[node], len(children))
+    order = [node]
+    for child_encoding, child_order in children:
+        encoding += child_encoding
+        order += child_order
+    return encoding, order
+
+
+def tree_canonical_order(labels, adjacency: Dict) -> Tuple[Tuple, List[int]]:
+
+    # Canonical int tuple of a labelled tree given as {node: [(neighbor,
+    # edge_label)]}: (0, center encoding) for one center, or (1, central
+    # edge label, smaller half, larger half) for two. Also returns the
+    # nodes in the order decode_tree numbers them.
+    centers = _tree_centers(adjacency)
+    if len(centers) > 2:
+        raise ValueError("TreePattern edges contain a cycle")
+    if len(centers) == 1:
+        encoding, order = _tree_encode(labels, adjacency, centers[0], None)
+        return (0,) + encoding, order
+    
+    u, v = centers
+    edge_label = next(label for neighbor, label in adjacency[u] if neighbor == v)
+    halves = sorted((_tree_encode(labels, adjacency, u, v), _tree_encode(labels, adjacency, v, u)))
+    return (1, edge_label) + halves[0][0] + halves[1][0], halves[0][1] + halves[1][1]
+
+
+def tree_canonical(labels, adjacency: Dict) -> Tuple:
+
+    return tree_canonical_order(labels, adjacency)[0]
+
+
+def _walk_tree_encoding(canonical: Tuple, pos: int, parent: Optional[Tuple], visit) -> int:
+
+    # Call visit(parent, label, n_children) for the node encoded at pos and
+    # then its subtree, preorder, where parent is (visit's result for the
+    # parent, edge label) or None. Returns the position after the subtree.
+    label, n_children = canonical[pos], canonical[pos + 1]
+    node = visit(parent, label, n_children)
+    pos += 2
+    for _ in range(n_children):
+        edge_label = canonical[pos]
+        pos = _walk_tree_encoding(canonical, pos + 1, (node, edge_label), visit)
+    return pos
+
+
+def decode_tree(canonical: Tuple) -> 'TreePattern':
+
+    tree = TreePattern()
+    
+    def visit(parent, label, n_children):
+        node = len(tree.nodes)
+        tree.add_node(node, label)
+        if parent is not None:
+            tree.add_edge(parent[0], node, parent[1])
+        return node
+    
+    if canonical:
+        pos = _walk_tree_encoding(canonical, 1 + canonical[0], None, visit)
+        if canonical[0] == 1:
+            second = len(tree.nodes)
+            _walk_tree_encoding(canonical, pos, None, visit)
+            tree.add_edge(0, second, canonical[1])
+    return tree
+
+
 class TreePattern:
 
     
@@ -73,32 +404,42 @@ class TreePattern:
         self.nodes = {}  
         self.edges = []  
         self.adjacency = defaultdict(list)  
+        self._canonical = None
         
     def add_node(self, node_id: int, label: int):
         self.nodes[node_id] = label
+        self._canonical = None
         
     def add_edge(self, src: int, dst: int, label: int):
         self.edges.append((src, dst, label))
         self.adjacency[src].append((dst, label))
         self.adjacency[dst].append((src, label))
+        self._canonical = None
     
     def __hash__(self):
 
         return hash(self._canonical_tuple())
     
     def __eq__(self, other):
-        return self._canonical_tuple() == other._canonical_tuple()
+        return isinstance(other, TreePattern) and self._canonical_tuple() == other._canonical_tuple()
     
     def _canonical_tuple(self):
 
-        if not self.nodes:
-            return ()
+        if self._canonical is None:
+            if not self.nodes and not self.edges:
+                self._canonical = ()
+            else:
+                adjacency = {node: self.adjacency.get(node, []) for node in self._node_ids()}
+                self._canonical = tree_canonical(defaultdict(int, self.nodes), adjacency)
+        return self._canonical
+    
+    def _node_ids(self) -> Set[int]:
 
-        sorted_edges = tuple(sorted(
-            (min(s,d), max(s,d), self.nodes.get(s,0), self.nodes.get(d,0), l) 
-            for s, d, l in self.edges
-        ))
-        return sorted_edges
+        node_ids = set(self.nodes)
+        for src, dst, _ in self.edges:
+            node_ids.add(src)
+            node_ids.add(dst)
+        return node_ids
     
     def to_graph(self) -> Graph:
 
@@ -110,194 +451,1041 @@ class TreePattern:
         return g
 
 
-def extract_paths_from_graph(graph: nx.Graph, max_length: int = 5) -> Set[PathPattern]:
+def extract_path_keys(graph, max_length: int = 5) -> Set[Tuple]:
+
+    # Canonical (node_labels, edge_labels) keys of all simple paths with 1
+    # to max_length edges. One mutable path is extended and backtracked in
+    # place over the CSR arrays, with a visited bitmap and a per-depth
+    # cursor into the neighbor slots. A path is only emitted from its
+    # lower-numbered end, so each undirected path is oriented once.
+    graph = as_compact(graph)
+    labels = graph.node_labels.tolist()
+    indptr = graph.indptr.tolist()
+    indices = graph.indices.tolist()
+    edge_labels = graph.edge_labels.tolist()
+    
+    keys = set()
+    visited = bytearray(graph.n_nodes)
+    
+    for start in range(graph.n_nodes):
+        visited[start] = 1
+        path = [start]
+        node_labels = [labels[start]]
+        path_edges = []
+        cursor = [indptr[start]]
+        
+        while cursor:
+            u = path[-1]
+            slot = cursor[-1]
+            
+            if slot < indptr[u + 1] and len(path_edges) < max_length:
+                cursor[-1] = slot + 1
+                v = indices[slot]
+                if visited[v]:
+                    continue
+                
+                visited[v] = 1
+                path.append(v)
+                node_labels.append(labels[v])
+                path_edges.append(edge_labels[slot])
+                cursor.append(indptr[v])
+                
+                if start < v:
+                    key = (tuple(node_labels), tuple(path_edges))
+                    reverse = (key[0][::-1], key[1][::-1])
+                    keys.add(reverse if reverse < key else key)
+            else:
+                cursor.pop()
+                visited[path.pop()] = 0
+                node_labels.pop()
+                if path_edges:
+                    path_edges.pop()
+    
+    return keys
+
+
+def extract_paths_from_graph(graph, max_length: int = 5) -> Set[PathPattern]:
   
-    paths = set()
+    return {PathPattern(*key) for key in extract_path_keys(graph, max_length)}
+
+
+def extract_tree_keys(graph, max_edges: int = 5) -> Set[bytes]:
+
+    # Keys of every subtree of the graph with up to max_edges edges that is
+    # not a path (paths are mined on their own).
+    keys = set()
+    if max_edges < 3:
+        return keys
     
-    def get_label(node):
-        return graph.nodes[node].get('label', 0)
+    graph = as_compact(graph)
+    miner = _SubtreeMiner([graph])
+    paths = {
+        _path_tree_key(node_labels + edge_labels)
+        for node_labels, edge_labels in extract_path_keys(graph, max_edges)
+    }
+    rows, _ = miner.first_level(paths)
     
-    def get_edge_label(u, v):
-        return graph[u][v].get('label', 0)
+    for _ in range(3, max_edges):
+        if not len(rows):
+            break
+        keys.update(miner.keys)
+        rows, _ = miner.extend(rows, np.arange(len(rows)))
+    keys.update(miner.keys)
     
+    return keys
 
-    for start_node in graph.nodes():
 
-        stack = [(start_node, [start_node], set([start_node]))]
-        
-        while stack:
-            current, path_nodes, visited = stack.pop()
-            
+def extract_trees_from_graph(graph, max_edges: int = 5) -> Set[TreePattern]:
+
+    return {decode_pattern(key) for key in extract_tree_keys(graph, max_edges)}
 
-            if len(path_nodes) > 1:
-                node_labels = tuple(get_label(n) for n in path_nodes)
-                edge_labels = tuple(
-                    get_edge_label(path_nodes[i], path_nodes[i+1]) 
-                    for i in range(len(path_nodes)-1)
-                )
-                pattern = PathPattern(node_labels, edge_labels).canonical_form()
-                paths.add(pattern)
-            
 
-            if len(path_nodes) - 1 < max_length:
-                for neighbor in graph.neighbors(current):
-                    if neighbor not in visited:
-                        new_visited = visited | {neighbor}
-                        new_path = path_nodes + [neighbor]
-                        stack.append((neighbor, new_path, new_visited))
+def extract_star_keys(graph, leaf_counts) -> Set[Tuple]:
+
+    # Every labeled star (center_label, sorted (edge_label, leaf_label)
+    # tuples) with the given numbers of leaves, over all neighbor subsets.
+    stars = set()
+    nodes, labels, adjacency = label_adjacency(graph)
+    
+    for center in nodes:
+        leaves = sorted((edge_label, labels[n]) for n, edge_label in adjacency[center])
+        
+        for n_leaves in leaf_counts:
+            for combo in combinations(leaves, n_leaves):
+                stars.add((labels[center], combo))
+    
+    return stars
+
+
+def _orient_path(node_labels: Tuple, edge_labels: Tuple, nodes: Tuple):
+
+    # Canonical orientation as in PathPattern.canonical_form; a palindromic
+    # label sequence fixes the embedding orientation by node order instead.
+    rev_nodes, rev_edges = node_labels[::-1], edge_labels[::-1]
+    if (rev_nodes, rev_edges) < (node_labels, edge_labels):
+        return (rev_nodes, rev_edges), nodes[::-1]
+    if (rev_nodes, rev_edges) == (node_labels, edge_labels):
+        return (node_labels, edge_labels), min(nodes, nodes[::-1])
+    return (node_labels, edge_labels), nodes
+
+
+def _key_rows(values: List[Tuple]) -> np.ndarray:
+
+    # Keys of one level as the rows of an int64 matrix; a level's keys all
+    # have the same width (2n + 1 for paths of n edges, 3n for trees of n
+    # nodes), so rows compare and hash as fixed-width packed keys.
+    if not values:
+        return np.zeros((0, 0), dtype=np.int64)
+    return np.array(values, dtype=np.int64)
+
+
+def _intern_level(locals_: Iterable[Dict]) -> Tuple[List[Dict], List, np.ndarray]:
+
+    # File each graph's {key: embeddings} under a dense id per distinct key
+    # of the level, so the level holds one copy of each key. Returns the
+    # re-keyed dicts, the keys by id and the number of graphs per id.
+    ids, keys, counts = {}, [], array('q')
+    embeddings = []
+    for local in locals_:
+        interned = {}
+        for key, embs in local.items():
+            lid = ids.get(key)
+            if lid is None:
+                lid = ids[key] = len(keys)
+                keys.append(key)
+                counts.append(0)
+            counts[lid] += 1
+            interned[lid] = embs
+        embeddings.append(interned)
+    return embeddings, keys, np.array(counts, dtype=np.int64)
+
+
+def _local_pids(rows: np.ndarray, frequent_rows: np.ndarray, pids: np.ndarray) -> List[int]:
+
+    # Pattern id of each of a range's key rows, -1 where it is infrequent.
+    lookup = dict(zip((row.tobytes() for row in frequent_rows), pids.tolist()))
+    return [lookup.get(row.tobytes(), -1) for row in rows]
+
+
+class _PathMiner:
+
+    # Level-wise path growth over a run of graphs, the per-range half of
+    # mine_frequent_paths. An embedding is the node tuple of a path in the
+    # orientation of its key; the embeddings of the current level stay here
+    # between calls, filed under a dense id per path. grow returns the
+    # level's paths as key rows with the number of graphs each occurs in,
+    # advance takes the frequent rows and their pattern ids, ORs their
+    # occurrences into this range's occurrence rows and moves on to their
+    # extensions, and finish returns those rows.
+    # With two_pass, sketch first counts the level into a count-min sketch
+    # and grow then keeps only the paths the summed sketches estimate at
+    # min_support or more.
+    
+    def __init__(self, graphs: Iterable):
+        self.graphs = [label_adjacency(as_compact(graph)) for graph in graphs]
+        self.embeddings = []
+        self.keys = []
+        self.rows = _key_rows([])
+        self.occurrences = OccurrenceBits(len(self.graphs))
+        self.frequent = None
+        self.extensions = {}
+    
+    def _grow_first(self, graph) -> Dict:
+
+        nodes, labels, adjacency = graph
+        local = defaultdict(set)
+        for u in nodes:
+            for v, edge_label in adjacency[u]:
+                if u < v:
+                    key, emb = _orient_path((labels[u], labels[v]), (edge_label,), (u, v))
+                    local[key].add(emb)
+        return local
+    
+    def _extend(self, parent, at_end, node_label, edge_label):
+
+        # (parent, end, node_label, edge_label) -> child key, or None when
+        # the child's other sub-path is infrequent.
+        ext = (parent, at_end, node_label, edge_label)
+        if ext not in self.extensions:
+            node_labels, edge_labels = parent
+            if at_end:
+                child = (node_labels + (node_label,), edge_labels + (edge_label,))
+                other = (child[0][1:], child[1][1:])
+            else:
+                child = ((node_label,) + node_labels, (edge_label,) + edge_labels)
+                other = (child[0][:-1], child[1][:-1])
+            other_key, _ = _orient_path(other[0], other[1], ())
+            self.extensions[ext] = child if other_key in self.frequent else None
+        return self.extensions[ext]
     
-    return paths
+    def _grow_next(self, graph, parents: Dict) -> Dict:
+
+        # Extend every embedding by one edge at either end.
+        local = defaultdict(set)
+        nodes, labels, adjacency = graph
+        for parent_id, embs in parents.items():
+            parent = self.keys[parent_id]
+            for emb in embs:
+                for at_end, tip in ((True, emb[-1]), (False, emb[0])):
+                    for w, edge_label in adjacency[tip]:
+                        if w in emb:
+                            continue
+                        child = self._extend(parent, at_end, labels[w], edge_label)
+                        if child is None:
+                            continue
+                        path_nodes = emb + (w,) if at_end else (w,) + emb
+                        key, oriented = _orient_path(child[0], child[1], path_nodes)
+                        local[key].add(oriented)
+        return local
+    
+    def _grow_all(self):
 
+        if self.frequent is None:
+            return (self._grow_first(graph) for graph in self.graphs)
+        return (self._grow_next(graph, parents) for graph, parents in zip(self.graphs, self.embeddings))
+    
+    def sketch(self) -> CountMinSketch:
 
-def extract_trees_from_graph(graph: nx.Graph, max_edges: int = 5) -> Set[TreePattern]:
-  
-    trees = set()
+        sketch = CountMinSketch()
+        for local in self._grow_all():
+            sketch.add(list(local))
+        return sketch
+    
+    def grow(self, sketch: Optional[CountMinSketch] = None,
+             min_support: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+
+        locals_ = self._grow_all()
+        if sketch is not None:
+            locals_ = (self._estimated(local, sketch, min_support) for local in locals_)
+        self.embeddings, self.keys, counts = _intern_level(locals_)
+        self.rows = _key_rows([node_labels + edge_labels for node_labels, edge_labels in self.keys])
+        return self.rows, counts
+    
+    @staticmethod
+    def _estimated(local: Dict, sketch: CountMinSketch, min_support: int) -> Dict:
+
+        if local:
+            keys = list(local)
+            for key, estimate in zip(keys, sketch.estimate(keys)):
+                if estimate < min_support:
+                    del local[key]
+        return local
+    
+    def advance(self, frequent_rows: np.ndarray, pids: np.ndarray):
+
+        # Drop infrequent paths and set the bits of the frequent ones.
+        pids = _local_pids(self.rows, frequent_rows, pids)
+        patterns, graph_ids = array('q'), array('q')
+        for idx, local in enumerate(self.embeddings):
+            for lid in list(local):
+                if pids[lid] < 0:
+                    del local[lid]
+                else:
+                    patterns.append(pids[lid])
+                    graph_ids.append(idx)
+        self.occurrences.add(patterns, graph_ids)
+        self.frequent = {key for key, pid in zip(self.keys, pids) if pid >= 0}
+        self.extensions = {}
     
-    def get_label(node):
-        return graph.nodes[node].get('label', 0)
+    def finish(self, frequent_rows: np.ndarray, pids: np.ndarray) -> OccurrenceBits:
+
+        self.advance(frequent_rows, pids)
+        self.embeddings = []
+        return self.occurrences
+
+
+def mine_frequent_paths(graphs: Iterable[Graph], min_support: int, max_length: int,
+                        two_pass: bool = False) -> Tuple[PatternTable, OccurrenceBits]:
+
+    # Level-wise pattern growth: only paths that are already frequent are
+    # extended, one edge at either end, from their stored embeddings. An
+    # extension is kept only if the sub-path at its other end is frequent
+    # too, since an infrequent path has no frequent super-path. Frequent
+    # paths go into a PatternTable, and occurrence rows are by pattern id.
+    #
+    # Growth is map-reduce style over graph ranges, laid out as in
+    # mine_frequent_trees: each range keeps its embeddings in its own
+    # worker, and every level the parent reduces the ranges' key rows and
+    # counts and answers with the frequent rows and their pattern ids,
+    # which the next level needs.
+    #
+    # With two_pass, each level is first streamed into a count-min sketch
+    # and then regrown, keeping embeddings and exact counts only for paths
+    # whose estimate reaches min_support. Estimates never undercount, so
+    # the result is the same; memory follows the frequent paths rather
+    # than every path seen, for twice the growth work. Sketches add up, so
+    # the ranges' sketches are summed into one before the regrowth.
+    table = PatternTable()
     
-    def get_edge_label(u, v):
-        return graph[u][v].get('label', 0)
+    with shared_store(graphs) as store:
+        occurrences = OccurrenceBits(len(store))
+        with _range_workers(_PathMiner, store) as (workers, ranges):
+            _reduce_path_levels(workers, ranges, min_support, max_length, two_pass, table, occurrences)
     
+    return table, occurrences
 
-    for center in graph.nodes():
-        neighbors = list(graph.neighbors(center))
-        if len(neighbors) >= 2:  
 
-            for i in range(len(neighbors)):
-                for j in range(i+1, min(i+4, len(neighbors))):  
-                    tree = TreePattern()
-                    tree.add_node(0, get_label(center))
-                    
-                    n1, n2 = neighbors[i], neighbors[j]
-                    tree.add_node(1, get_label(n1))
-                    tree.add_node(2, get_label(n2))
-                    tree.add_edge(0, 1, get_edge_label(center, n1))
-                    tree.add_edge(0, 2, get_edge_label(center, n2))
+def _merge_sketches(left: CountMinSketch, right: CountMinSketch) -> CountMinSketch:
+
+    left.table += right.table
+    return left
+
+
+def _reduce_path_levels(workers: List, ranges: List[Tuple[int, int]], min_support: int,
+                        max_length: int, two_pass: bool, table: PatternTable,
+                        occurrences: OccurrenceBits):
+
+    frequent_paths = []
+    if not workers:
+        return
+    
+    path_kind = PATTERN_KINDS.index('path')
+    length = 1
+    while True:
+        sketch = None
+        if two_pass:
+            for worker in workers:
+                worker.send('sketch')
+            sketch = _tree_reduce([worker.recv() for worker in workers], _merge_sketches)
+        for worker in workers:
+            worker.send('grow', sketch, min_support)
+        level = _tree_reduce([worker.recv() for worker in workers], _merge_level_counts)
+        
+        rows, pids = _intern_frequent(level, min_support, table, path_kind)
+        frequent_paths.extend(pids.tolist())
+        
+        print(f"  Paths of length {length}: {len(pids)} frequent")
+        if not len(pids) or length >= max_length:
+            break
+        
+        for worker in workers:
+            worker.send('advance', rows, pids)
+        for worker in workers:
+            worker.recv()
+        length += 1
+    
+    # One row per path in pattern id order, then each range's rows ORed in.
+    occurrences.extend({pid: () for pid in frequent_paths})
+    for worker in workers:
+        worker.send('finish', rows, pids)
+    mapping = {pid: pid for pid in frequent_paths}
+    for (start, _), worker in zip(ranges, workers):
+        occurrences.merge_range(worker.recv(), start, mapping)
+
+
+def _path_tree_key(values: Tuple) -> bytes:
+
+    # Tree key of the path with path key values (node labels, then edge
+    # labels), for checking path-shaped subtrees against the path miner.
+    n_nodes = (len(values) + 1) // 2
+    adjacency = {node: [] for node in range(n_nodes)}
+    for node, edge_label in enumerate(values[n_nodes:]):
+        adjacency[node].append((node + 1, edge_label))
+        adjacency[node + 1].append((node, edge_label))
+    return tree_key(tree_canonical(values[:n_nodes], adjacency))
+
+
+def _decode_tree_lists(key: bytes) -> Tuple[List[int], Dict]:
+
+    # Node labels and {node: [(neighbor, edge_label)]} of a tree key, with
+    # nodes numbered as decode_tree numbers them.
+    tree = decode_tree(_unpack_key(key))
+    labels = [tree.nodes[node] for node in range(len(tree.nodes))]
+    return labels, {node: list(tree.adjacency[node]) for node in range(len(labels))}
+
+
+class _SubtreeMiner:
+
+    # Level-wise growth of the non-path subtrees of a run of graphs, from
+    # the 3-edge stars up. An embedding maps pattern node i (numbered as
+    # decode_tree numbers the pattern) to a graph node; it is filed under
+    # the frozenset of graph edge ids it covers, so an occurrence reached
+    # from several parents is kept once.
+    #
+    # A child is its parent plus one edge to a new node at pattern node i.
+    # Its key, its node renumbering and whether every subtree left by
+    # deleting one of its leaves is frequent depend only on (parent, i,
+    # edge label, node label), so they are worked out once per extension
+    # and not per embedding. Path-shaped trees are not grown here: their
+    # frequent set comes from the path miner and only serves that check.
+    # Every non-path tree but the 3-edge star loses a leaf to some non-path
+    # tree, so growing non-path trees from the stars reaches them all.
+    
+    def __init__(self, graphs: Iterable):
+        self.graphs = []
+        for graph in graphs:
+            nodes, labels, adjacency = label_adjacency(graph)
+            endpoints = []
+            incident = [[] for _ in nodes]
+            for u in nodes:
+                for v, edge_label in adjacency[u]:
+                    if u < v:
+                        incident[u].append((v, len(endpoints)))
+                        incident[v].append((u, len(endpoints)))
+                        endpoints.append((u, v, edge_label))
+            self.graphs.append((labels, endpoints, incident))
+        
+        self.embeddings = []
+        self.keys = []
+        self.rows = _key_rows([])
+        self.frequent = set()
+        self.occurrences = OccurrenceBits(len(self.graphs))
+        self.paths = set()
+        self.extensions = {}
+    
+    def _admissible(self, labels: List[int], adjacency: Dict, frequent: Set[bytes]) -> bool:
+
+        # Every subtree left by deleting one leaf is frequent, as a tree of
+        # this level or as a path.
+        for leaf, neighbors in adjacency.items():
+            if len(neighbors) != 1:
+                continue
+            rest = {
+                node: [(v, edge_label) for v, edge_label in adjacency[node] if v != leaf]
+                for node in adjacency if node != leaf
+            }
+            key = tree_key(tree_canonical(labels, rest))
+            if key not in frequent and key not in self.paths:
+                return False
+        return True
+    
+    def first_level(self, paths: Set[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+
+        # Every 3-edge star; paths holds the tree keys of the frequent paths.
+        self.paths = paths
+        self.extensions = {}
+        return self._intern(self._stars())
+    
+    def _stars(self) -> Iterable[Dict]:
+
+        stars = {}
+        for labels, endpoints, incident in self.graphs:
+            local = defaultdict(dict)
+            for center, edges in enumerate(incident):
+                for trio in combinations(edges, 3):
+                    # Leaves in label order, so stars with one signature
+                    # are laid out alike and share the renumbering.
+                    leaves = sorted((endpoints[eid][2], labels[w], w, eid) for w, eid in trio)
+                    signature = (labels[center],) + tuple(leaf[:2] for leaf in leaves)
+                    if signature not in stars:
+                        star_labels = [labels[center]] + [leaf[1] for leaf in leaves]
+                        adjacency = {0: [(i, leaf[0]) for i, leaf in enumerate(leaves, 1)]}
+                        for i, leaf in enumerate(leaves, 1):
+                            adjacency[i] = [(0, leaf[0])]
+                        canonical, order = tree_canonical_order(star_labels, adjacency)
+                        admissible = self._admissible(star_labels, adjacency, set())
+                        stars[signature] = (tree_key(canonical), order) if admissible else None
                     
-                    trees.add(tree)
+                    if stars[signature] is not None:
+                        key, order = stars[signature]
+                        star_nodes = (center,) + tuple(leaf[2] for leaf in leaves)
+                        local[key][frozenset(leaf[3] for leaf in leaves)] = tuple(star_nodes[i] for i in order)
+            yield local
     
-    return trees
+    def _intern(self, locals_: Iterable[Dict]) -> Tuple[np.ndarray, np.ndarray]:
 
+        self.embeddings, self.keys, counts = _intern_level(locals_)
+        self.rows = _key_rows([_unpack_key(key) for key in self.keys])
+        return self.rows, counts
+    
+    def _record(self, frequent_rows: np.ndarray, pids: np.ndarray):
+
+        # Drop infrequent trees and set the bits of the frequent ones.
+        pids = _local_pids(self.rows, frequent_rows, pids)
+        patterns, graph_ids = array('q'), array('q')
+        for idx, local in enumerate(self.embeddings):
+            for lid in list(local):
+                if pids[lid] < 0:
+                    del local[lid]
+                else:
+                    patterns.append(pids[lid])
+                    graph_ids.append(idx)
+        self.occurrences.add(patterns, graph_ids)
+        self.frequent = {key for key, pid in zip(self.keys, pids) if pid >= 0}
+    
+    def _extension(self, parent: bytes, pos: int, edge_label: int, node_label: int,
+                   frequent: Set[bytes]) -> Optional[Tuple[bytes, List[int]]]:
+
+        # (child key, child node i as a parent node or len(parent) for the
+        # new one) for an edge to a new node at parent node pos, or None
+        # when the child has an infrequent leaf-deleted subtree.
+        ext = (parent, pos, edge_label, node_label)
+        if ext not in self.extensions:
+            labels, adjacency = _decode_tree_lists(parent)
+            new = len(labels)
+            labels.append(node_label)
+            adjacency[pos].append((new, edge_label))
+            adjacency[new] = [(pos, edge_label)]
+            canonical, order = tree_canonical_order(labels, adjacency)
+            admissible = self._admissible(labels, adjacency, frequent)
+            self.extensions[ext] = (tree_key(canonical), order) if admissible else None
+        return self.extensions[ext]
+    
+    def extend(self, frequent_rows: np.ndarray, pids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
 
-def gaston_mine_patterns(graphs: List[Graph], min_support: int = 2, 
-                         max_path_length: int = 4, include_trees: bool = True) -> Dict:
+        # Grow every frequent embedding by one edge to a new node.
+        self._record(frequent_rows, pids)
+        return self._intern(self._children())
     
+    def _children(self) -> Iterable[Dict]:
 
-    path_counts = Counter()
-    path_occurrences = defaultdict(set)
+        for i, (graph, parents) in enumerate(zip(self.graphs, self.embeddings)):
+            labels, endpoints, incident = graph
+            local = defaultdict(dict)
+            
+            for parent_id, embs in parents.items():
+                parent = self.keys[parent_id]
+                for edges, nodes in embs.items():
+                    for pos, u in enumerate(nodes):
+                        for w, eid in incident[u]:
+                            if w in nodes:
+                                continue
+                            ext = self._extension(parent, pos, endpoints[eid][2], labels[w], self.frequent)
+                            if ext is None:
+                                continue
+                            
+                            key, order = ext
+                            child = edges | {eid}
+                            children = local[key]
+                            if child not in children:
+                                grown = nodes + (w,)
+                                children[child] = tuple(grown[j] for j in order)
+            
+            self.embeddings[i] = None
+            yield local
     
-    try:
-        from joblib import Parallel, delayed
+    def finish(self, frequent_rows: np.ndarray, pids: np.ndarray) -> OccurrenceBits:
+
+        self._record(frequent_rows, pids)
+        self.embeddings = []
+        return self.occurrences
+
+
+def _serve_miner(conn, miner_class, store: GraphStore, start: int, end: int):
+
+    # Worker loop: run the miner's methods on request until told to stop.
+    miner = miner_class(store.range(start, end))
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        method, args = request
+        try:
+            conn.send(getattr(miner, method)(*args))
+        except Exception as e:
+            conn.send(e)
+    conn.close()
+
+
+class _LocalRange:
+
+    # A range mined in this process, with the same calls as _RemoteRange.
+    
+    def __init__(self, miner_class, store: GraphStore, start: int, end: int):
+        self.miner = miner_class(store.range(start, end))
+        self.result = None
+    
+    def send(self, method: str, *args):
+        self.result = getattr(self.miner, method)(*args)
+    
+    def recv(self):
+        return self.result
+    
+    def close(self):
+        self.miner = None
+
+
+class _RemoteRange:
+
+    # A range mined in its own process, driven over a pipe so that its
+    # embeddings stay in the worker from one level to the next.
+    
+    def __init__(self, miner_class, store: GraphStore, start: int, end: int):
         import multiprocessing
-        
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_serve_miner, args=(child, miner_class, store, start, end), daemon=True
+        )
+        self.process.start()
+        child.close()
+    
+    def send(self, method: str, *args):
+        self.conn.send((method, args))
+    
+    def recv(self):
+        result = self.conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join()
+
 
-        n_jobs = min(multiprocessing.cpu_count(), 4)
+@contextlib.contextmanager
+def _range_workers(miner_class, store: GraphStore):
+
+    # One miner per contiguous range of the store, each in its own process
+    # when there is more than one range. Ranges start on multiples of 64
+    # graphs so their occurrence rows land on whole words.
+    import multiprocessing
+    n_graphs = len(store)
+    n_jobs = multiprocessing.cpu_count()
+    
+    range_size = max(64, -(-n_graphs // n_jobs // 64) * 64)
+    ranges = [(start, min(start + range_size, n_graphs)) for start in range(0, n_graphs, range_size)]
+    worker_class = _RemoteRange if len(ranges) > 1 else _LocalRange
+    
+    workers = []
+    try:
+        workers.extend(worker_class(miner_class, store, start, end) for start, end in ranges)
+        yield workers, ranges
+    finally:
+        for worker in workers:
+            worker.close()
+
+
+def _merge_level_counts(left: Tuple[np.ndarray, np.ndarray],
+                        right: Tuple[np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+
+    # Sum two (key rows, counts) pairs of one level over their distinct rows.
+    if not len(left[1]):
+        return right
+    if not len(right[1]):
+        return left
+    rows, inverse = np.unique(np.concatenate([left[0], right[0]]), axis=0, return_inverse=True)
+    counts = np.zeros(len(rows), dtype=np.int64)
+    np.add.at(counts, inverse.ravel(), np.concatenate([left[1], right[1]]))
+    return rows, counts
+
+
+def _intern_frequent(level: Tuple[np.ndarray, np.ndarray], min_support: int,
+                     table: PatternTable, kind: int) -> Tuple[np.ndarray, np.ndarray]:
+
+    # Add the rows of a reduced level that reach min_support to table, in
+    # key order; returns those rows and their pattern ids. Only here do the
+    # rows become pattern keys.
+    rows, counts = level
+    keep = counts >= min_support
+    rows, counts = rows[keep], counts[keep]
+    if len(rows):
+        order = np.lexsort(rows.T[::-1])
+        rows, counts = rows[order], counts[order]
+    pids = [table.add(_pack_key(kind, row), count) for row, count in zip(rows.tolist(), counts.tolist())]
+    return rows, np.array(pids, dtype=np.int64)
+
+
+def _tree_reduce(items: List, merge):
+
+    # Merge neighbours pairwise until one item is left, keeping the order.
+    while len(items) > 1:
+        items = [
+            merge(items[i], items[i + 1]) if i + 1 < len(items) else items[i]
+            for i in range(0, len(items), 2)
+        ]
+    return items[0]
+
+
+def mine_frequent_trees(graphs: Iterable[Graph], min_support: int, max_edges: int,
+                        table: PatternTable, occurrences: OccurrenceBits) -> List[int]:
+
+    # Level-wise frequent subtree mining, map-reduce style over contiguous
+    # graph ranges with one worker process per range. Each level the
+    # workers grow their own embeddings and return their key rows and
+    # counts, which the parent reduces as a tree and answers with the
+    # frequent rows and their pattern ids. At the
+    # end each worker returns its occurrence rows once, and the parent ORs
+    # them into the shared matrix. Growth starts at the 3-edge stars,
+    # checked against the frequent paths already in table. Frequent non-path
+    # trees are added to table; returns their pattern ids.
+    path_kind = PATTERN_KINDS.index('path')
+    paths = {_path_tree_key(_unpack_key(key)) for key in table.keys if key[0] == path_kind}
+    
+    with shared_store(graphs) as store:
+        with _range_workers(_SubtreeMiner, store) as (workers, ranges):
+            return _reduce_tree_levels(workers, ranges, paths, min_support, max_edges, table, occurrences)
+
+
+def _reduce_tree_levels(workers: List, ranges: List[Tuple[int, int]], paths: Set[bytes],
+                        min_support: int, max_edges: int, table: PatternTable,
+                        occurrences: OccurrenceBits) -> List[int]:
+
+    frequent_trees = []
+    if not workers or max_edges < 3:
+        return []
+    
+    for worker in workers:
+        worker.send('first_level', paths)
+    
+    tree_kind = PATTERN_KINDS.index('tree')
+    edges = 3
+    while True:
+        level = _tree_reduce([worker.recv() for worker in workers], _merge_level_counts)
+        rows, pids = _intern_frequent(level, min_support, table, tree_kind)
+        frequent_trees.extend(pids.tolist())
         
-        CHUNK_SIZE = 5000  
-        n_graphs = len(graphs)
-        n_chunks = (n_graphs + CHUNK_SIZE - 1) // CHUNK_SIZE
+        print(f"  Trees of {edges} edges: {len(pids)} frequent")
+        if not len(pids) or edges >= max_edges:
+            break
         
+        for worker in workers:
+            worker.send('extend', rows, pids)
+        edges += 1
+    
+    for worker in workers:
+        worker.send('finish', rows, pids)
+    mapping = {pid: pid for pid in frequent_trees}
+    for (start, _), worker in zip(ranges, workers):
+        occurrences.merge_range(worker.recv(), start, mapping)
+    
+    return frequent_trees
 
-        
-        def process_graph_paths(idx, graph, max_length):
-            nx_graph = graph.to_networkx()
-            paths = extract_paths_from_graph(nx_graph, max_length)
 
-            return [(hash(p), p, idx) for p in paths]
+def gaston_mine_patterns(graphs: Iterable[Graph], min_support: int = 2, 
+                         max_path_length: int = 4, include_trees: bool = True,
+                         two_pass: bool = False) -> Dict:
+    
+
+    table, occurrences = mine_frequent_paths(graphs, min_support, max_path_length, two_pass)
+
+    
+    if include_trees:
+        mine_frequent_trees(graphs, min_support, max_path_length, table, occurrences)
+
+    
+
+    
+    return {
+        'patterns': table,
+        'occurrences': occurrences
+    }
+
+
+VACANT = -1
+
+
+class SubgraphPattern:
+
+    # A connected pattern identified by its minimum DFS code: a tuple of
+    # (frm, to, frm_label, edge_label, to_label) edges, VACANT where the
+    # vertex label was already given by an earlier edge.
+    
+    def __init__(self, code: Tuple = ()):
+        self.code = code
+    
+    def __hash__(self):
+        return hash(self.code)
+    
+    def __eq__(self, other):
+        return isinstance(other, SubgraphPattern) and self.code == other.code
+    
+    def __repr__(self):
+        return f"DFS{self.code}"
+    
+    def __len__(self):
+        return len(self.code)
+    
+    def to_graph(self) -> Graph:
+
+        g = Graph()
+        for frm, to, frm_label, edge_label, to_label in self.code:
+            if frm_label != VACANT:
+                g.add_node(frm, frm_label)
+            if to_label != VACANT:
+                g.add_node(to, to_label)
+            g.add_edge(frm, to, edge_label)
+        return g
+
+
+class _Projection:
+
+    # One embedding of the current DFS code, stored as a chain of graph
+    # edges (frm, to, edge_label, eid) back to the first one.
+    __slots__ = ('gid', 'edge', 'prev')
+    
+    def __init__(self, gid: int, edge: Tuple, prev: Optional['_Projection']):
+        self.gid = gid
+        self.edge = edge
+        self.prev = prev
+
+
+class _History:
+
+    __slots__ = ('edges', 'vertices', 'eids')
+    
+    def __init__(self, projection: _Projection):
+        edges = []
+        while projection is not None:
+            edges.append(projection.edge)
+            projection = projection.prev
+        edges.reverse()
         
+        self.edges = edges
+        self.vertices = set()
+        self.eids = set()
+        for frm, to, _, eid in edges:
+            self.vertices.add(frm)
+            self.vertices.add(to)
+            self.eids.add(eid)
 
-        for chunk_idx in range(n_chunks):
-            start_idx = chunk_idx * CHUNK_SIZE
-            end_idx = min(start_idx + CHUNK_SIZE, n_graphs)
-            chunk_graphs = graphs[start_idx:end_idx]
-            
-            if n_chunks > 1:
-                print(f"  Chunk {chunk_idx + 1}/{n_chunks} (graphs {start_idx}-{end_idx-1})...")
-            
 
-            chunk_results = Parallel(n_jobs=n_jobs, verbose=5)(
-                delayed(process_graph_paths)(start_idx + i, g, max_path_length)
-                for i, g in enumerate(chunk_graphs)
-            )
-            
+def _build_rmpath(code: List[Tuple]) -> List[int]:
 
-            for graph_paths in chunk_results:
-                seen = set()  
-                for _, pattern, idx in graph_paths:
-                    if pattern not in seen:
-                        path_counts[pattern] += 1
-                        path_occurrences[pattern].add(idx)
-                        seen.add(pattern)
-            
+    # Indices of the forward edges on the rightmost path, deepest first.
+    rmpath = []
+    old_frm = None
+    for i in range(len(code) - 1, -1, -1):
+        frm, to = code[i][0], code[i][1]
+        if frm < to and (old_frm is None or to == old_frm):
+            rmpath.append(i)
+            old_frm = frm
+    return rmpath
 
-            del chunk_results
+
+class _GSpanGraph:
+
+    # Vertex labels plus, per vertex, its edges as (frm, to, edge_label, eid).
+    __slots__ = ('labels', 'edges')
+    
+    def __init__(self, graph):
+        nodes, labels, adjacency = label_adjacency(as_compact(graph))
+        self.labels = labels
+        self.edges = [[] for _ in nodes]
         
-    except ImportError:
+        eids = {}
+        for u in nodes:
+            for v, edge_label in adjacency[u]:
+                eid = eids.setdefault((min(u, v), max(u, v)), len(eids))
+                self.edges[u].append((u, v, edge_label, eid))
+    
+    @classmethod
+    def from_code(cls, code: List[Tuple]) -> '_GSpanGraph':
 
-        for idx, graph in enumerate(graphs):
-            if idx % 100 == 0:
-                print(f"  Processing graph {idx}/{len(graphs)}...")
-            
-            nx_graph = graph.to_networkx()
-            paths = extract_paths_from_graph(nx_graph, max_path_length)
-            
-            for pattern in paths:
-                path_counts[pattern] += 1
-                path_occurrences[pattern].add(idx)
+        return cls(CompactGraph.from_graph(SubgraphPattern(tuple(code)).to_graph()))
     
-    frequent_paths = {p: c for p, c in path_counts.items() if c >= min_support}
+    def forward_root_edges(self, frm: int) -> List[Tuple]:
 
+        return [e for e in self.edges[frm] if self.labels[frm] <= self.labels[e[1]]]
     
-    frequent_trees = {}
-    tree_occurrences = {}
+    def backward_edge(self, e1: Tuple, e2: Tuple, history: _History) -> Optional[Tuple]:
+
+        if e1 == e2:
+            return None
+        for e in self.edges[e2[1]]:
+            if e[3] in history.eids or e[1] != e1[0]:
+                continue
+            if e1[2] < e[2] or (e1[2] == e[2] and self.labels[e1[1]] <= self.labels[e2[1]]):
+                return e
+        return None
     
-    if include_trees:
+    def forward_pure_edges(self, rm_edge: Tuple, min_label: int, history: _History) -> List[Tuple]:
+
+        return [
+            e for e in self.edges[rm_edge[1]]
+            if min_label <= self.labels[e[1]] and e[1] not in history.vertices
+        ]
+    
+    def forward_rmpath_edges(self, rm_edge: Tuple, min_label: int, history: _History) -> List[Tuple]:
+
+        to_label = self.labels[rm_edge[1]]
+        result = []
+        for e in self.edges[rm_edge[0]]:
+            new_to_label = self.labels[e[1]]
+            if rm_edge[1] == e[1] or min_label > new_to_label or e[1] in history.vertices:
+                continue
+            if rm_edge[2] < e[2] or (rm_edge[2] == e[2] and to_label <= new_to_label):
+                result.append(e)
+        return result
 
-        tree_counts = Counter()
-        tree_occurrences = defaultdict(set)
+
+def _is_min_code(code: List[Tuple]) -> bool:
+
+    # Rebuild the minimum DFS code of the pattern edge by edge and stop at
+    # the first position where it departs from the given code.
+    if len(code) == 1:
+        return True
+    
+    g = _GSpanGraph.from_code(code)
+    root = defaultdict(list)
+    for vid in range(len(g.labels)):
+        for e in g.forward_root_edges(vid):
+            root[(g.labels[vid], e[2], g.labels[e[1]])].append(_Projection(0, e, None))
+    
+    min_key = min(root)
+    min_code = [(0, 1) + min_key]
+    projected = root[min_key]
+    
+    while True:
+        rmpath = _build_rmpath(min_code)
+        min_label = min_code[0][2]
+        maxtoc = min_code[rmpath[0]][1]
+        histories = [_History(p) for p in projected]
         
-        try:
-            def process_graph_trees(idx, graph, max_edges):
-                nx_graph = graph.to_networkx()
-                trees = extract_trees_from_graph(nx_graph, max_edges)
-                return [(t, idx) for t in trees]
+
+        backward_root = defaultdict(list)
+        new_to = None
+        for i in range(len(rmpath) - 1, 0, -1):
+            for p, history in zip(projected, histories):
+                e = g.backward_edge(history.edges[rmpath[i]], history.edges[rmpath[0]], history)
+                if e is not None:
+                    backward_root[e[2]].append(_Projection(0, e, p))
+                    new_to = min_code[rmpath[i]][0]
+            if backward_root:
+                break
+        
+        if backward_root:
+            edge_label = min(backward_root)
+            min_code.append((maxtoc, new_to, VACANT, edge_label, VACANT))
+            if code[len(min_code) - 1] != min_code[-1]:
+                return False
+            projected = backward_root[edge_label]
+            continue
+        
+
+        forward_root = defaultdict(list)
+        new_frm = None
+        for p, history in zip(projected, histories):
+            edges = g.forward_pure_edges(history.edges[rmpath[0]], min_label, history)
+            if edges:
+                new_frm = maxtoc
+                for e in edges:
+                    forward_root[(e[2], g.labels[e[1]])].append(_Projection(0, e, p))
+        
+        if new_frm is None:
+            for rmpath_i in rmpath:
+                for p, history in zip(projected, histories):
+                    edges = g.forward_rmpath_edges(history.edges[rmpath_i], min_label, history)
+                    if edges:
+                        new_frm = min_code[rmpath_i][0]
+                        for e in edges:
+                            forward_root[(e[2], g.labels[e[1]])].append(_Projection(0, e, p))
+                if new_frm is not None:
+                    break
+        
+        if new_frm is None:
+            return True
+        
+        key = min(forward_root)
+        min_code.append((new_frm, maxtoc + 1, VACANT) + key)
+        if code[len(min_code) - 1] != min_code[-1]:
+            return False
+        projected = forward_root[key]
+
+
+def gspan_mine_patterns(graphs: Iterable[Graph], min_support: int = 2,
+                        max_edges: int = 5) -> Dict:
+
+    # gSpan: grow DFS codes by rightmost-path extension over projected
+    # embedding lists, and prune every code that is not the minimum DFS
+    # code of its pattern, so each connected subgraph is reported once.
+    db = [_GSpanGraph(g) for g in graphs]
+    
+    table = PatternTable()
+    occurrences = OccurrenceBits(len(db))
+    
+    def mine(code: List[Tuple], projected: List[_Projection]):
+        gids = {p.gid for p in projected}
+        if len(gids) < min_support or not _is_min_code(code):
+            return
+        
+        occurrences.extend({table.add(subgraph_key(code), len(gids)): gids})
+        if len(code) >= max_edges:
+            return
+        
+
+        rmpath = _build_rmpath(code)
+        maxtoc = code[rmpath[0]][1]
+        min_label = code[0][2]
+        
+        forward_root = defaultdict(list)
+        backward_root = defaultdict(list)
+        
+        for p in projected:
+            g = db[p.gid]
+            history = _History(p)
             
-            results = Parallel(n_jobs=n_jobs, verbose=5)(
-                delayed(process_graph_trees)(idx, g, max_path_length)
-                for idx, g in enumerate(graphs)
-            )
+            for rmpath_i in rmpath[::-1]:
+                e = g.backward_edge(history.edges[rmpath_i], history.edges[rmpath[0]], history)
+                if e is not None:
+                    backward_root[(code[rmpath_i][0], e[2])].append(_Projection(p.gid, e, p))
             
-            for graph_trees in results:
-                seen = set()
-                for pattern, idx in graph_trees:
-                    if pattern not in seen:
-                        tree_counts[pattern] += 1
-                        tree_occurrences[pattern].add(idx)
-                        seen.add(pattern)
-                        
-        except:
-            for idx, graph in enumerate(graphs):
-                if idx % 100 == 0:
-                    print(f"  Processing graph {idx}/{len(graphs)}...")
-                
-                nx_graph = graph.to_networkx()
-                trees = extract_trees_from_graph(nx_graph, max_path_length)
-                
-                for pattern in trees:
-                    tree_counts[pattern] += 1
-                    tree_occurrences[pattern].add(idx)
+            for e in g.forward_pure_edges(history.edges[rmpath[0]], min_label, history):
+                forward_root[(maxtoc, e[2], g.labels[e[1]])].append(_Projection(p.gid, e, p))
+            
+            for rmpath_i in rmpath:
+                for e in g.forward_rmpath_edges(history.edges[rmpath_i], min_label, history):
+                    forward_root[(code[rmpath_i][0], e[2], g.labels[e[1]])].append(_Projection(p.gid, e, p))
         
-        frequent_trees = {t: c for t, c in tree_counts.items() if c >= min_support}
 
+        for to, edge_label in sorted(backward_root):
+            code.append((maxtoc, to, VACANT, edge_label, VACANT))
+            mine(code, backward_root[(to, edge_label)])
+            code.pop()
+        
+        for frm, edge_label, to_label in sorted(forward_root, key=lambda x: (-x[0], x[1], x[2])):
+            code.append((frm, maxtoc + 1, VACANT, edge_label, to_label))
+            mine(code, forward_root[(frm, edge_label, to_label)])
+            code.pop()
     
 
+    root = defaultdict(list)
+    for gid, g in enumerate(db):
+        for vid in range(len(g.labels)):
+            for e in g.forward_root_edges(vid):
+                root[(g.labels[vid], e[2], g.labels[e[1]])].append(_Projection(gid, e, None))
+    
+    for key in sorted(root):
+        mine([(0, 1) + key], root[key])
+    
+    print(f"  gSpan: {len(table)} frequent subgraphs up to {max_edges} edges")
     
     return {
-        'paths': frequent_paths,
-        'path_occurrences': path_occurrences,
-        'trees': frequent_trees,
-        'tree_occurrences': tree_occurrences
+        'patterns': table,
+        'occurrences': occurrences
     }
 
 
@@ -331,63 +1519,234 @@ def calculate_overlap(sg1_graphs: set, sg2_graphs: set) -> float:
     return intersection / union if union > 0 else 0.0
 
 
+def _max_overlap(bits: np.ndarray, counts: np.ndarray,
+                 selected_bits: np.ndarray, selected_counts: np.ndarray) -> np.ndarray:
+
+    # Largest Jaccard overlap of each candidate row with any selected row;
+    # an empty occurrence set overlaps nothing, as in calculate_overlap.
+    inter = popcount_rows(bits[:, None, :] & selected_bits[None, :, :])
+    union = counts[:, None] + selected_counts[None, :] - inter
+    overlap = np.zeros(inter.shape)
+    np.divide(inter, union, out=overlap, where=union > 0)
+    return overlap.max(axis=1)
+
+
+def select_diverse_rows(bits: np.ndarray, order: np.ndarray, k: int,
+                        overlap_threshold: float) -> List[int]:
+
+    # Greedy diversity filter over the candidates bits[order], in order: a
+    # candidate is kept when its overlap with every kept one is at most
+    # overlap_threshold. Candidates are compared a block at a time against
+    # all kept rows, and a block is only rescanned against rows it adds.
+    # Returns positions in order.
+    n_words = bits.shape[1]
+    selected = []
+    selected_bits = np.zeros((max(k, 1), n_words), dtype=np.uint64)
+    selected_counts = np.zeros(max(k, 1), dtype=np.int64)
+    block_size = max(1, BLOCK_ELEMENTS // (max(k, 1) * n_words))
+    
+    for start in range(0, len(order), block_size):
+        if len(selected) >= k:
+            break
+        
+        block = bits[order[start:start + block_size]]
+        counts = popcount_rows(block)
+        if selected:
+            n = len(selected)
+            overlap = _max_overlap(block, counts, selected_bits[:n], selected_counts[:n])
+        else:
+            overlap = np.zeros(len(block))
+        
+        pos = 0
+        while len(selected) < k:
+            hits = np.flatnonzero(overlap[pos:] <= overlap_threshold)
+            if not len(hits):
+                break
+            i = pos + int(hits[0])
+            
+            selected_bits[len(selected)] = block[i]
+            selected_counts[len(selected)] = counts[i]
+            selected.append(start + i)
+            
+            pos = i + 1
+            if pos < len(block):
+                overlap[pos:] = np.maximum(overlap[pos:], _max_overlap(
+                    block[pos:], counts[pos:], block[i:i + 1], counts[i:i + 1]
+                ))
+    
+    return selected
+
+
+WORKLOAD_SIZE = 200
+WORKLOAD_EDGES = (2, 10)
+
+
+def _sample_connected(graph, n_edges: int, rng: random.Random) -> Graph:
+
+    # A connected subgraph of graph grown from a random node, one random
+    # frontier edge at a time, until it has n_edges edges or stops growing.
+    graph = as_compact(graph)
+    labels = graph.node_labels.tolist()
+    src, dst, edge_labels = (a.tolist() for a in graph.edge_arrays())
+    
+    nodes = {rng.randrange(graph.n_nodes)} if graph.n_nodes else set()
+    chosen = []
+    remaining = set(range(len(src)))
+    while len(chosen) < n_edges:
+        frontier = sorted(e for e in remaining if src[e] in nodes or dst[e] in nodes)
+        if not frontier:
+            break
+        e = rng.choice(frontier)
+        remaining.discard(e)
+        chosen.append(e)
+        nodes.update((src[e], dst[e]))
+    
+    ids = {node: i for i, node in enumerate(sorted(nodes))}
+    query = Graph()
+    for node, i in ids.items():
+        query.add_node(i, labels[node])
+    for e in chosen:
+        query.add_edge(ids[src[e]], ids[dst[e]], edge_labels[e])
+    return query
+
+
+def sample_query_workload(graphs: Iterable[Graph], n_queries: int = WORKLOAD_SIZE,
+                          min_edges: int = WORKLOAD_EDGES[0], max_edges: int = WORKLOAD_EDGES[1],
+                          seed: int = 0) -> List[Graph]:
+
+    # Stand-in workload when no real queries are at hand: connected
+    # subgraphs of random database graphs, so each has at least one answer.
+    rng = random.Random(seed)
+    picks = Counter(rng.randrange(len(graphs)) for _ in range(n_queries))
+    queries = []
+    
+    for g_idx, graph in enumerate(graphs):
+        for _ in range(picks.get(g_idx, 0)):
+            queries.append(_sample_connected(graph, rng.randint(min_edges, max_edges), rng))
+        if len(queries) == n_queries:
+            break
+    
+    return queries
+
+
+def workload_containment(table: PatternTable, queries: List[Graph], max_edges: int) -> np.ndarray:
+
+    # contains[q, pid] is True when query q contains pattern pid. Path and
+    # tree patterns are looked up among the query's own path and subtree
+    # keys; gSpan patterns go through VF2. A VF2 test that exhausts its
+    # budget counts as absent, which only undercounts a pattern's pruning.
+    from feature_extractor import BudgetExceeded, VERIFY_MAX_STEPS, is_subgraph_isomorphic
+    
+    kinds = np.array([key[0] for key in table.keys], dtype=np.int8)
+    has_trees = bool(np.any(kinds == PATTERN_KINDS.index('tree')))
+    subgraph_ids = np.flatnonzero(kinds == PATTERN_KINDS.index('subgraph'))
+    subgraphs = [table.pattern(pid).to_graph() for pid in subgraph_ids]
+    contains = np.zeros((len(queries), len(table.keys)), dtype=bool)
+    
+    for q_idx, query in enumerate(queries):
+        keys = {path_key(*key) for key in extract_path_keys(query, max_edges)}
+        if has_trees:
+            keys.update(extract_tree_keys(query, max_edges))
+        contains[q_idx, [table.ids[key] for key in keys if key in table.ids]] = True
+        
+        for pid, pattern in zip(subgraph_ids, subgraphs):
+            try:
+                contains[q_idx, pid] = is_subgraph_isomorphic(pattern, query, VERIFY_MAX_STEPS)
+            except BudgetExceeded:
+                pass
+    
+    return contains
+
+
+def select_workload_rows(bits: np.ndarray, order: np.ndarray, contains: np.ndarray,
+                         k: int, n_graphs: int) -> Tuple[List[int], float]:
+
+    # Lazy greedy over the candidates bits[order]: a query's candidate set
+    # is the AND of the selected rows it contains (contains[:, i] for
+    # candidate i), and a row's gain is the number of candidates it removes
+    # over all queries. Candidate-set shrinkage is a coverage function, so
+    # gains only fall as rows are picked; a stale gain is an upper bound and
+    # only the top of the heap needs recomputing. Ties go to the earlier
+    # candidate. Returns positions in order and the mean candidate count
+    # the selection leaves the workload with.
+    n_queries = contains.shape[0]
+    rows = bits[order]
+    counts = popcount_rows(rows)
+    
+    full = np.zeros(rows.shape[1] * 8, dtype=np.uint8)
+    full[:-(-n_graphs // 8)] = np.packbits(np.ones(n_graphs, dtype=bool), bitorder='little')
+    candidates = np.tile(full.view(np.uint64), (n_queries, 1))
+    sizes = np.full(n_queries, n_graphs, dtype=np.int64)
+    
+    bounds = contains.sum(axis=0) * (n_graphs - counts)
+    heap = [(-int(bound), i) for i, bound in enumerate(bounds) if bound > 0]
+    heapify(heap)
+    selected = []
+    
+    while heap and len(selected) < k:
+        _, i = heappop(heap)
+        users = np.flatnonzero(contains[:, i])
+        kept = candidates[users] & rows[i]
+        kept_sizes = popcount_rows(kept)
+        gain = int(sizes[users].sum() - kept_sizes.sum())
+        if gain <= 0:
+            continue
+        if heap and (-gain, i) > heap[0]:
+            heappush(heap, (-gain, i))
+            continue
+        
+        selected.append(i)
+        candidates[users] = kept
+        sizes[users] = kept_sizes
+    
+    return selected, float(sizes.mean()) if n_queries else 0.0
+
+
 def select_discriminative_patterns(patterns_result: Dict, k: int, n_graphs: int,
-                                    overlap_threshold: float = 0.5) -> List[Graph]:
+                                    overlap_threshold: float = 0.5,
+                                    workload: Optional[List[Graph]] = None,
+                                    max_edges: int = 5) -> List[Graph]:
    
     
 
     all_patterns = []
-    all_occurrences = {}
+    table = patterns_result['patterns']
+    occurrences = patterns_result['occurrences']
     
 
-    for pattern, freq in patterns_result['paths'].items():
+    for pid, freq in enumerate(table.support):
         ig = calculate_information_gain(freq, n_graphs)
-        all_patterns.append((pattern, ig, freq, 'path'))
-        all_occurrences[pattern] = patterns_result['path_occurrences'].get(pattern, set())
-    
-
-    for pattern, freq in patterns_result['trees'].items():
-        ig = calculate_information_gain(freq, n_graphs)
-        all_patterns.append((pattern, ig, freq, 'tree'))
-        all_occurrences[pattern] = patterns_result['tree_occurrences'].get(pattern, set())
+        all_patterns.append((pid, ig, freq, table.kind(pid)))
     
 
     all_patterns.sort(key=lambda x: x[1], reverse=True)
     
 
-    for i, (pattern, score, freq, ptype) in enumerate(all_patterns[:10]):
+    for i, (pid, score, freq, ptype) in enumerate(all_patterns[:10]):
         print(f"  {i+1}. [{ptype}] Freq: {freq}/{n_graphs} ({freq/n_graphs*100:.1f}%), IG: {score:.4f}")
     
 
-    selected = []
-    selected_graph_sets = []
+    order = np.array([occurrences.rows[p[0]] for p in all_patterns], dtype=np.int64)
+    if workload is None:
+        chosen = select_diverse_rows(occurrences.bits, order, k, overlap_threshold)
+    else:
+        contains = workload_containment(table, workload, max_edges)
+        contains = contains[:, [p[0] for p in all_patterns]]
+        chosen, mean_candidates = select_workload_rows(occurrences.bits, order, contains, k, n_graphs)
+        print(f"  Workload of {len(workload)} queries: mean candidates {n_graphs} -> {mean_candidates:.1f} "
+              f"with {len(chosen)} patterns")
     
-    for pattern, score, freq, ptype in all_patterns:
-        if len(selected) >= k:
-            break
-        
-        pattern_graphs = all_occurrences.get(pattern, set())
-        
 
-        is_diverse = True
-        for existing_graphs in selected_graph_sets:
-            if calculate_overlap(pattern_graphs, existing_graphs) > overlap_threshold:
-                is_diverse = False
+    if len(chosen) < k:
+        chosen_set = set(chosen)
+        for i in range(len(all_patterns)):
+            if len(chosen) >= k:
                 break
-        
-        if is_diverse:
-            selected.append((pattern, score, freq, ptype))
-            selected_graph_sets.append(pattern_graphs)
+            if i not in chosen_set:
+                chosen.append(i)
+                chosen_set.add(i)
     
-
-    if len(selected) < k:
-        selected_set = {id(s[0]) for s in selected}
-        for pattern, score, freq, ptype in all_patterns:
-            if len(selected) >= k:
-                break
-            if id(pattern) not in selected_set:
-                selected.append((pattern, score, freq, ptype))
-                selected_set.add(id(pattern))
+    selected = [all_patterns[i] for i in chosen]
     
 
     path_count = sum(1 for s in selected if s[3] == 'path')
@@ -396,14 +1755,16 @@ def select_discriminative_patterns(patterns_result: Dict, k: int, n_graphs: int,
     
 
     result_graphs = []
-    for pattern, _, _, ptype in selected:
-        result_graphs.append(pattern.to_graph())
+    for pid, _, _, ptype in selected:
+        result_graphs.append(table.pattern(pid).to_graph())
     
     return result_graphs
 
 
-def select_discriminative_subgraphs(graphs: List[Graph], k: int = 50, 
-                                     max_size: int = 5) -> List[Graph]:
+def select_discriminative_subgraphs(graphs: Iterable[Graph], k: int = 50, 
+                                     max_size: int = 5, miner: str = 'gaston',
+                                     two_pass: bool = False, selection: str = 'diverse',
+                                     workload: Optional[List[Graph]] = None) -> List[Graph]:
    
     n_graphs = len(graphs)
     
@@ -411,18 +1772,26 @@ def select_discriminative_subgraphs(graphs: List[Graph], k: int = 50,
     min_support = max(2, int(0.20 * n_graphs))
     
     print(f"\n{'='*60}")
-    print(f"GASTON Frequent Subgraph Mining")
+    print(f"{miner.upper()} Frequent Subgraph Mining")
     print(f"{'='*60}")
     print(f"Graphs: {n_graphs}, k: {k}, max_size: {max_size}")
     print(f"Minimum support: {min_support} ({min_support/n_graphs*100:.1f}%)")
     
 
-    patterns_result = gaston_mine_patterns(
-        graphs, 
-        min_support=min_support,
-        max_path_length=max_size,
-        include_trees=True  
-    )
+    if miner == 'gspan':
+        patterns_result = gspan_mine_patterns(
+            graphs,
+            min_support=min_support,
+            max_edges=max_size
+        )
+    else:
+        patterns_result = gaston_mine_patterns(
+            graphs, 
+            min_support=min_support,
+            max_path_length=max_size,
+            include_trees=True,
+            two_pass=two_pass
+        )
     overlap_threshold = 0.8
 
     if n_graphs > 10000:
@@ -431,11 +1800,18 @@ def select_discriminative_subgraphs(graphs: List[Graph], k: int = 50,
         overlap_threshold = 0.8  
 
     
+    # 'workload' picks patterns for the candidate sets they leave a sample
+    # of queries with, synthesized from the database when none is given.
+    if selection == 'workload' and workload is None:
+        workload = sample_query_workload(graphs)
+    
     selected_graphs = select_discriminative_patterns(
         patterns_result, 
         k=k, 
         n_graphs=n_graphs,
-        overlap_threshold=overlap_threshold
+        overlap_threshold=overlap_threshold,
+        workload=workload if selection == 'workload' else None,
+        max_edges=max_size
     )
     
 
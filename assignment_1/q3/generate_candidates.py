@@ -1,7 +1,36 @@
 
 
+import os
 import sys
+import hashlib
+import json
+import pickle
+import multiprocessing
 import numpy as np
+from collections import Counter, defaultdict
+from typing import Optional, Tuple
+from graph_utils import as_compact, isomorphism_class
+from graph_store import shared_store
+from feature_extractor import (
+    FILTER_STATS, BudgetExceeded, is_subgraph_isomorphic, print_filter_stats
+)
+import feature_extractor
+from fsm import popcount_rows
+
+
+BLOCK_ELEMENTS = 1 << 22
+DB_BLOCK_SIZE = 1 << 16
+
+
+def pack_features(features: np.ndarray) -> np.ndarray:
+
+    bits = np.packbits(np.asarray(features) != 0, axis=1)
+    
+
+    n_bytes = max(8, -(-bits.shape[1] // 8) * 8)
+    bits = np.pad(bits, ((0, 0), (0, n_bytes - bits.shape[1])))
+    
+    return np.ascontiguousarray(bits).view(np.uint64)
 
 
 def generate_candidates(db_features: np.ndarray, query_features: np.ndarray) -> dict:
@@ -9,28 +38,212 @@ def generate_candidates(db_features: np.ndarray, query_features: np.ndarray) ->
     n_queries = query_features.shape[0]
     n_db_graphs = db_features.shape[0]
     
+
+    # A DB graph is a candidate when it has every feature the query has,
+    # i.e. no query bit survives masking with the inverted DB row.
+    db_missing = ~pack_features(db_features)
+    query_bits = pack_features(query_features)
+    n_words = query_bits.shape[1]
+    
+    db_block = max(1, min(n_db_graphs, DB_BLOCK_SIZE))
+    query_block = max(1, BLOCK_ELEMENTS // (db_block * n_words))
     
     candidates = {}
     
-    for q_idx in range(n_queries):
-        query_vec = query_features[q_idx]
-        candidate_list = []
+    for q_start in range(0, n_queries, query_block):
+        q_end = min(q_start + query_block, n_queries)
+        q_bits = query_bits[q_start:q_end, None, :]
+        matches = [[] for _ in range(q_end - q_start)]
         
 
-        for db_idx in range(n_db_graphs):
-            db_vec = db_features[db_idx]
+        for db_start in range(0, n_db_graphs, db_block):
+            db_end = min(db_start + db_block, n_db_graphs)
+            
+            contained = ~np.any(q_bits & db_missing[None, db_start:db_end, :], axis=2)
+            rows, cols = np.nonzero(contained)
             
-            if np.all(query_vec <= db_vec):
-                candidate_list.append(db_idx)  
+            splits = np.searchsorted(rows, np.arange(1, q_end - q_start))
+            for i, block_cols in enumerate(np.split(cols + db_start, splits)):
+                matches[i].append(block_cols)
         
-        candidates[q_idx] = candidate_list  
+        for i, parts in enumerate(matches):
+            candidates[q_start + i] = np.concatenate(parts).tolist() if parts else []
         
-        if (q_idx + 1) % 10 == 0:
-            print(f"Processed query {q_idx + 1}/{n_queries}")
+        print(f"Processed query {q_end}/{n_queries}")
     
     return candidates
 
 
+class FeatureIndex:
+
+    # One posting bitmap per feature column: bit i of row f is set when DB
+    # graph i has feature f. Candidates are the AND of the query's columns.
+    
+    def __init__(self, postings: np.ndarray, support: np.ndarray, n_graphs: int):
+        self.postings = postings
+        self.support = support
+        self.n_graphs = n_graphs
+    
+    @classmethod
+    def build(cls, db_features: np.ndarray) -> 'FeatureIndex':
+
+        db_features = np.asarray(db_features)
+        postings = pack_features(db_features.T)
+        support = np.count_nonzero(db_features, axis=0).astype(np.int64)
+        return cls(postings, support, db_features.shape[0])
+    
+    def save(self, features_path: str, stamp: Optional[dict] = None):
+
+        # The stamp goes last, so an interrupted save leaves no valid index.
+        postings_path, support_path, stamp_path = index_paths(features_path)
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+        np.save(postings_path, self.postings)
+        np.save(support_path, self.support)
+        if stamp is not None:
+            with open(stamp_path, 'w') as f:
+                json.dump(stamp, f)
+    
+    @classmethod
+    def load(cls, features_path: str) -> 'FeatureIndex':
+
+        postings_path, support_path, _ = index_paths(features_path)
+        n_graphs = np.load(features_path, mmap_mode='r').shape[0]
+        postings = np.load(postings_path, mmap_mode='r')
+        support = np.load(support_path)
+        return cls(postings, support, n_graphs)
+    
+    def query(self, query_vec: np.ndarray) -> list:
+
+        return self._ids(*self._filter(np.flatnonzero(query_vec)))
+    
+    def _filter(self, columns: np.ndarray, start: Optional[Tuple[np.ndarray, np.ndarray]] = None):
+
+        # AND the posting rows of columns, as (words, acc): the indices of
+        # the words that can still hold candidates and their bits. Starts
+        # from every graph or, given start, from an earlier (words, acc).
+        columns = columns[np.argsort(self.support[columns], kind='stable')]
+        
+        if start is not None:
+            words, acc = start
+            acc = acc.copy()
+        elif columns.size == 0:
+            words = np.arange(self.postings.shape[1])
+            acc = pack_features(np.ones((1, self.n_graphs), dtype=bool))[0, :words.size]
+        elif self.support[columns[0]] == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+        else:
+        
+            # After the most selective column only its non-empty words can
+            # still hold candidates, so later columns are gathered on those.
+            first = np.asarray(self.postings[columns[0]])
+            words = np.flatnonzero(first)
+            acc = first[words]
+            columns = columns[1:]
+        
+        for col in columns:
+            acc &= self.postings[col, words]
+            keep = np.flatnonzero(acc)
+            if keep.size == 0:
+                return words[:0], acc[:0]
+            if keep.size < words.size:
+                words = words[keep]
+                acc = acc[keep]
+        
+        return words, acc
+    
+    @staticmethod
+    def _ids(words: np.ndarray, acc: np.ndarray) -> list:
+
+        bits = np.unpackbits(acc.view(np.uint8)).reshape(-1, 64)
+        word_idx, bit_idx = np.nonzero(bits)
+        return (words[word_idx] * 64 + bit_idx).tolist()
+    
+    def query_all(self, query_features: np.ndarray) -> dict:
+
+        # Each distinct feature vector is filtered once. Vectors go in order
+        # of feature count, so when a vector contains an earlier one whose
+        # candidates are fewer than its most selective posting row, only its
+        # extra columns are ANDed into those candidates. Results stay packed
+        # until the end.
+        n_queries = query_features.shape[0]
+        vectors, inverse = np.unique(np.asarray(query_features) != 0, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        n_vectors = vectors.shape[0]
+        
+        vector_bits = pack_features(vectors)
+        n_columns = vectors.sum(axis=1)
+        sizes = np.zeros(n_vectors, dtype=np.int64)
+        done = np.zeros(n_vectors, dtype=bool)
+        results = [None] * n_vectors
+        
+        for i, v in enumerate(np.argsort(n_columns, kind='stable')):
+            columns = np.flatnonzero(vectors[v])
+            base = None
+            if i and columns.size:
+                contained = done & ~np.any(vector_bits & ~vector_bits[v], axis=1)
+                if contained.any():
+                    base = int(np.flatnonzero(contained)[np.argmin(sizes[contained])])
+                    if sizes[base] >= self.support[columns].min():
+                        base = None
+            
+            if base is None:
+                results[v] = self._filter(columns)
+            else:
+                results[v] = self._filter(np.flatnonzero(vectors[v] & ~vectors[base]), results[base])
+            sizes[v] = popcount_rows(results[v][1])
+            done[v] = True
+            
+            if (i + 1) % 1000 == 0:
+                print(f"Processed feature vector {i + 1}/{n_vectors}")
+        
+        print(f"Filtered {n_queries} queries as {n_vectors} distinct feature vectors")
+        results = [self._ids(words, acc) for words, acc in results]
+        return {q_idx: list(results[inverse[q_idx]]) for q_idx in range(n_queries)}
+
+
+def index_paths(features_path: str):
+
+    stem = features_path[:-4] if features_path.endswith('.npy') else features_path
+    return f"{stem}.postings.npy", f"{stem}.support.npy", f"{stem}.index.json"
+
+
+def features_stamp(features_path: str) -> dict:
+
+    # Size, mtime and content digest of the features file an index is built
+    # from; the digest catches a same-shaped replacement with an older mtime.
+    st = os.stat(features_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(features_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 22), b''):
+            digest.update(chunk)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': digest.hexdigest()}
+
+
+def load_or_build_index(features_path: str) -> FeatureIndex:
+
+    postings_path, support_path, stamp_path = index_paths(features_path)
+    stamp = features_stamp(features_path)
+    
+    try:
+        with open(stamp_path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = None
+    if saved == stamp and os.path.exists(postings_path) and os.path.exists(support_path):
+        return FeatureIndex.load(features_path)
+    
+
+    print(f"Building feature index for {features_path}...")
+    index = FeatureIndex.build(np.load(features_path, mmap_mode='r'))
+    try:
+        index.save(features_path, stamp)
+    except OSError as e:
+        print(f"  Cannot write the index next to {features_path} ({e.strerror}), keeping it in memory")
+        return index
+    return FeatureIndex.load(features_path)
+
+
 def save_candidates(candidates: dict, filepath: str):
    
     with open(filepath, 'w') as f:
@@ -64,16 +277,203 @@ def print_statistics(candidates: dict, db_features: np.ndarray):
     print("=" * 60)
 
 
-def compute_scores(candidates: dict, query_graphs, db_graphs, verbose: bool = True):
-   
-    import sys
-    sys.path.insert(0, '.')
-    from feature_extractor import is_subgraph_isomorphic
+VERIFY_BATCH_SIZE = 64
+
+_VERIFY = {}
+
+
+def _init_verify_worker(query_graphs, db_graphs, found, first_m: Optional[int]):
+
+    # Pool initializer: both graph sets stay resident in the worker, so a
+    # task is only a query index and a slice of its candidate ids.
+    _VERIFY['queries'] = query_graphs
+    _VERIFY['db'] = db_graphs
+    _VERIFY['found'] = found
+    _VERIFY['first_m'] = first_m
+
+
+def _verify_batch(task):
+
+    # Verify one slice of a query group's candidates. With a budget, pairs
+    # that exhaust it come back as slow ids instead of holding up the batch.
+    g_idx, db_ids, bounded = task
+    FILTER_STATS.clear()
+    query = _VERIFY['queries'][g_idx]
+    found = _VERIFY['found']
+    first_m = _VERIFY['first_m']
+    max_steps = feature_extractor.VERIFY_MAX_STEPS if bounded else None
+    max_seconds = feature_extractor.VERIFY_MAX_SECONDS if bounded else None
+    
+    decided = {}
+    slow = []
+    for db_id in db_ids:
+        if first_m is not None and found[g_idx] >= first_m:
+            break
+        try:
+            decided[db_id] = is_subgraph_isomorphic(query, _VERIFY['db'][db_id], max_steps, max_seconds)
+        except BudgetExceeded:
+            slow.append(db_id)
+            continue
+        if decided[db_id]:
+            with found.get_lock():
+                found[g_idx] += 1
+    return g_idx, decided, slow, Counter(FILTER_STATS)
+
+
+def _collect(results, known: list, stats: Counter) -> list:
+
+    slow = defaultdict(list)
+    for g_idx, decided, slow_ids, batch_stats in results:
+        known[g_idx].update(decided)
+        stats.update(batch_stats)
+        if slow_ids:
+            slow[g_idx].extend(slow_ids)
+    return sorted(slow.items())
+
+
+def db_fingerprint(db_graphs) -> str:
+
+    # Digest of the DB graphs' compact buffers, in order, so a cache keyed
+    # by DB id can tell whether it was built against the same database.
+    digest = hashlib.blake2b(digest_size=16)
+    for graph in db_graphs:
+        compact = as_compact(graph)
+        digest.update(np.int64(compact.n_nodes).tobytes())
+        digest.update(np.ascontiguousarray(compact.data).tobytes())
+    return f"{len(db_graphs)}:{digest.hexdigest()}"
+
+
+class VerificationCache:
+
+    # Verification outcomes per query isomorphism class: {db_id: matched}.
+    # Queries are bucketed by Weisfeiler-Lehman hash and a real isomorphism
+    # check picks the class, so relabelled copies of a query share results.
+    # Outcomes are keyed by DB id, so the file records the fingerprint of
+    # its database and is discarded when loaded against another one.
+    
+    def __init__(self, path: Optional[str] = None, fingerprint: Optional[str] = None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.buckets = defaultdict(list)
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            if isinstance(state, dict) and state.get('fingerprint') == fingerprint:
+                self.buckets.update(state['buckets'])
+            else:
+                print(f"Ignoring verification cache {path}: built for a different database")
+    
+    def results(self, query) -> dict:
+
+        return isomorphism_class(self.buckets, query, {})[0]
+    
+    def save(self, path: Optional[str] = None):
+
+        path = self.path if path is None else path
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'fingerprint': self.fingerprint, 'buckets': dict(self.buckets)}, f)
+        os.replace(tmp_path, path)
+
+
+def verify_candidates(candidates: dict, query_graphs, db_graphs, first_m: Optional[int] = None,
+                      verbose: bool = True, cache: Optional[VerificationCache] = None):
+
+    # Isomorphic queries form one group, verified once over the union of
+    # their candidates minus the pairs the cache already holds. Groups are
+    # sharded over a process pool and their outcomes streamed into the
+    # cache. With first_m set, a group stops once that many have matched,
+    # so there each query is its own group over its own candidates; it
+    # still shares the outcomes of its isomorphism class.
+    q_ids = sorted(candidates)
+    cache = VerificationCache() if cache is None else cache
+    
+    group_of = {}
+    groups = []
+    queries = []
+    known = []
+    pending = []
+    for q_idx, q_id in enumerate(q_ids):
+        results = cache.results(query_graphs[q_idx])
+        key = id(results) if first_m is None else q_idx
+        if key not in group_of:
+            group_of[key] = len(queries)
+            queries.append(query_graphs[q_idx])
+            known.append(results)
+            pending.append({})
+        groups.append(group_of[key])
+        pending[groups[-1]].update(dict.fromkeys(candidates[q_id]))
+    
+    found = multiprocessing.Array('i', len(queries))
+    pairs = []
+    n_cached = 0
+    for g_idx, results in enumerate(known):
+        found[g_idx] = sum(results.get(db_id, False) for db_id in pending[g_idx])
+        todo = [db_id for db_id in pending[g_idx] if db_id not in results]
+        n_cached += len(pending[g_idx]) - len(todo)
+        if todo and (first_m is None or found[g_idx] < first_m):
+            pairs.append((g_idx, todo))
+    
+    n_classes = len({id(results) for results in known})
+    if verbose and (n_cached or n_classes < len(q_ids)):
+        print(f"Verifying {len(q_ids)} queries as {n_classes} isomorphism classes, "
+              f"{n_cached} pairs answered from the cache")
+    
+    stats = Counter()
+    
+    def tasks(pairs, bounded):
+        for g_idx, db_ids in pairs:
+            for start in range(0, len(db_ids), VERIFY_BATCH_SIZE):
+                yield g_idx, db_ids[start:start + VERIFY_BATCH_SIZE], bounded
+    
+    def verify(run):
+        slow = _collect(run(tasks(pairs, True)), known, stats)
+        if slow and verbose:
+            print(f"\nVerifying {sum(len(ids) for _, ids in slow)} pairs that exhausted the VF2 budget without one...")
+        _collect(run(tasks(slow, False)), known, stats)
+    
+    n_jobs = multiprocessing.cpu_count()
+    n_tasks = sum(-(-len(db_ids) // VERIFY_BATCH_SIZE) for _, db_ids in pairs)
+    
+    if n_jobs == 1 or n_tasks <= 1:
+        _init_verify_worker(queries, db_graphs, found, first_m)
+        try:
+            verify(lambda batches: map(_verify_batch, batches))
+        finally:
+            _VERIFY.clear()
+    
+    else:
+        with shared_store(db_graphs) as store:
+            with multiprocessing.Pool(n_jobs, _init_verify_worker, (queries, store, found, first_m)) as pool:
+                verify(lambda batches: pool.imap_unordered(_verify_batch, batches))
+    
+    matches = {}
+    for q_id, g_idx in zip(q_ids, groups):
+        matched = sum(known[g_idx].get(db_id, False) for db_id in candidates[q_id])
+        matches[q_id] = matched if first_m is None else min(matched, first_m)
+    return matches, stats
+
+
+def compute_scores(candidates: dict, query_graphs, db_graphs, verbose: bool = True,
+                   first_m: Optional[int] = None, cache_path: Optional[str] = None):
     
     scores = {}
     total_rq = 0
     total_cq = 0
     
+
+    # Pairs that exhaust the VF2 budget wait in a slow queue, so one
+    # pathological target does not hold up every other query. In first_m
+    # mode |Rq| is the number of matches found before the query stopped.
+    # With cache_path, outcomes persist across runs against the same DB.
+    if cache_path is None:
+        cache = VerificationCache()
+    else:
+        cache = VerificationCache(cache_path, db_fingerprint(db_graphs))
+    matches, stats = verify_candidates(candidates, query_graphs, db_graphs, first_m, verbose, cache)
+    if cache_path is not None:
+        cache.save()
+    
     if verbose:
         print("\n" + "=" * 60)
         print("Performance Metric: sq = |Rq| / |Cq|")
@@ -81,16 +481,9 @@ def compute_scores(candidates: dict, query_graphs, db_graphs, verbose: bool = Tr
         print(f"{'Query':<8} {'|Cq|':<8} {'|Rq|':<8} {'sq':<10} {'Status'}")
         print("-" * 60)
     
-    for q_idx, (q_id, cand_list) in enumerate(sorted(candidates.items())):
-        query = query_graphs[q_idx]
-        
+    for q_id, cand_list in sorted(candidates.items()):
         cq = len(cand_list)
-        rq = 0
-        
-        for db_id in cand_list:
-            db_graph = db_graphs[db_id]  
-            if is_subgraph_isomorphic(query, db_graph):
-                rq += 1
+        rq = matches[q_id]
         
         sq = rq / cq if cq > 0 else 0.0
         
@@ -121,6 +514,7 @@ def compute_scores(candidates: dict, query_graphs, db_graphs, verbose: bool = Tr
         print("-" * 60)
         print(f"{'AVG':<8} {avg_cq:<8.1f} {avg_rq:<8.1f} {avg_sq:<10.4f}")
         print("=" * 60)
+        print_filter_stats(stats)
         print(f"\nHigher sq is better (means smaller candidate sets)")
         print(f"Perfect score is 1.0 (Cq = Rq, no false positives)")
     
@@ -135,6 +529,11 @@ def compute_scores(candidates: dict, query_graphs, db_graphs, verbose: bool = Tr
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        from candidate_server import main as serve_main
+        serve_main(sys.argv[2:])
+        return
+    
     if len(sys.argv) != 4:
         print("Usage: python generate_candidates.py <path_database_graph_features> <path_query_graph_features> <path_out_file>")
         sys.exit(1)
@@ -144,11 +543,13 @@ def main():
     output_path = sys.argv[3]
     
 
-    db_features = np.load(db_features_path)
+    db_features = np.load(db_features_path, mmap_mode='r')
 
     query_features = np.load(query_features_path)
 
-    candidates = generate_candidates(db_features, query_features)
+    index = load_or_build_index(db_features_path)
+    
+    candidates = index.query_all(query_features)
     
     print_statistics(candidates, db_features)
     
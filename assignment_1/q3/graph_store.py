@@ -0,0 +1,276 @@
+"""
+Binary graph store: a text or .gspan dataset compiled once into flat
+arrays that every pipeline stage memory-maps instead of re-parsing.
+
+<dataset>.store (.iso.store when deduplicated up to isomorphism) is a
+symlink to the current version in <dataset>.store.versions/, laid out as:
+    graphs.bin     int32 CompactGraph buffers, back to back
+    offsets.npy    int64 start of graph i in graphs.bin (n_graphs + 1 entries)
+    n_nodes.npy    int32 node count of graph i
+    graph_ids.npy  int64 position of graph i in the source file
+    source.json    size, mtime_ns and inode of the source it was built from
+"""
+
+import atexit
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+from typing import Iterable, Iterator, Optional
+from graph_utils import CompactGraph, as_compact, iter_graphs, iter_unique
+
+
+STORE_SUFFIXES = {'exact': '.store', 'isomorphic': '.iso.store', None: '.all.store'}
+
+
+def store_path_for(source_path: str, dedupe: Optional[str] = 'exact') -> str:
+
+    return source_path.rstrip('/') + STORE_SUFFIXES[dedupe]
+
+
+def source_stamp(source_path: str) -> dict:
+
+    # Identifies one revision of a dataset file; a copy that keeps an older
+    # mtime still differs in inode or size.
+    st = os.stat(source_path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'ino': st.st_ino}
+
+
+def read_stamp(store_path: str) -> Optional[dict]:
+
+    try:
+        with open(os.path.join(store_path, 'source.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_store(graphs: Iterable, store_path: str, stamp: Optional[dict] = None) -> int:
+
+    # Write graphs into a fresh version directory, then point store_path at
+    # it with an atomic symlink swap: readers never map a half-written
+    # store, concurrent writers never share a directory, and the previous
+    # version is only removed once the new one is in place. stamp, if
+    # given, is recorded as the source revision. Returns the graph count.
+    versions_path = store_path + '.versions'
+    os.makedirs(versions_path, exist_ok=True)
+    with _versions_lock(versions_path):
+        tmp_path = tempfile.mkdtemp(dir=versions_path)
+        writing = open(os.path.join(tmp_path, '.writing'), 'w')
+        fcntl.flock(writing, fcntl.LOCK_EX)
+    os.chmod(tmp_path, 0o755)
+    
+    try:
+        offsets = [0]
+        n_nodes = []
+        graph_ids = []
+        
+        with open(os.path.join(tmp_path, 'graphs.bin'), 'wb') as f:
+            for graph in graphs:
+                compact = as_compact(graph)
+                f.write(compact.data.tobytes())
+                offsets.append(offsets[-1] + compact.data.shape[0])
+                n_nodes.append(compact.n_nodes)
+                graph_ids.append(-1 if graph.graph_id is None else graph.graph_id)
+        
+        np.save(os.path.join(tmp_path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'n_nodes.npy'), np.array(n_nodes, dtype=np.int32))
+        np.save(os.path.join(tmp_path, 'graph_ids.npy'), np.array(graph_ids, dtype=np.int64))
+        if stamp is not None:
+            with open(os.path.join(tmp_path, 'source.json'), 'w') as f:
+                json.dump(stamp, f)
+        
+        _swap_in(tmp_path, store_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    finally:
+        writing.close()
+    return len(n_nodes)
+
+
+@contextlib.contextmanager
+def _versions_lock(versions_path: str) -> Iterator[None]:
+
+    with open(os.path.join(versions_path, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _swap_in(version_path: str, store_path: str):
+
+    # os.replace of a symlink is atomic; a real directory cannot be replaced
+    # that way, so a store from before versioning is first moved in among
+    # the versions. Under the lock, every version other than the new one
+    # whose writer no longer holds its .writing lock is then removed: the
+    # one just replaced, and any left behind by a crashed writer.
+    versions_path = os.path.dirname(version_path)
+    with _versions_lock(versions_path):
+        previous = os.path.realpath(store_path) if os.path.islink(store_path) else None
+        if os.path.isdir(store_path) and previous is None:
+            os.rename(store_path, os.path.join(tempfile.mkdtemp(dir=versions_path), 'store'))
+        
+        link_path = version_path + '.link'
+        os.symlink(os.path.join(os.path.basename(versions_path), os.path.basename(version_path)), link_path)
+        os.replace(link_path, store_path)
+        
+        if previous is not None and os.path.dirname(previous) != os.path.realpath(versions_path):
+            shutil.rmtree(previous, ignore_errors=True)
+        for name in os.listdir(versions_path):
+            path = os.path.join(versions_path, name)
+            if name == '.lock' or path == version_path:
+                continue
+            if os.path.isdir(path) and not _is_being_written(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def _is_being_written(version_path: str) -> bool:
+
+    try:
+        with open(os.path.join(version_path, '.writing')) as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+    except FileNotFoundError:
+        pass
+    return False
+
+
+def compile_store(source_path: str, store_path: Optional[str] = None,
+                  dedupe: Optional[str] = 'exact') -> str:
+
+    store_path = store_path or store_path_for(source_path, dedupe)
+    stamp = source_stamp(source_path)
+    
+    graphs = iter_graphs(source_path)
+    if dedupe:
+        graphs = iter_unique(graphs, dedupe)
+    
+    n_graphs = write_store(graphs, store_path, stamp)
+    print(f"  Compiled {n_graphs} graphs into {store_path}")
+    return store_path
+
+
+class GraphStore:
+
+    # Random access to compiled graphs; graph i is a zero-copy view into
+    # the mapped buffer. Pickles as its path, so workers map the same pages.
+    
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        
+        # Map one version as a whole; if a concurrent write swapped it out
+        # and removed it mid-way, map the version that replaced it.
+        while True:
+            version_path = os.path.realpath(store_path)
+            try:
+                self._map(version_path)
+                return
+            except FileNotFoundError:
+                if os.path.realpath(store_path) == version_path:
+                    raise
+    
+    def _map(self, version_path: str):
+        self.offsets = np.load(os.path.join(version_path, 'offsets.npy'), mmap_mode='r')
+        self.n_nodes = np.load(os.path.join(version_path, 'n_nodes.npy'), mmap_mode='r')
+        self.graph_ids = np.load(os.path.join(version_path, 'graph_ids.npy'), mmap_mode='r')
+        
+        data_path = os.path.join(version_path, 'graphs.bin')
+        if os.path.getsize(data_path) > 0:
+            self.data = np.memmap(data_path, dtype=np.int32, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.int32)
+    
+    def __len__(self) -> int:
+        return self.n_nodes.shape[0]
+    
+    def __getitem__(self, i: int) -> CompactGraph:
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"graph index {i} out of range")
+        return CompactGraph(self.data[self.offsets[i]:self.offsets[i + 1]], int(self.n_nodes[i]), int(self.graph_ids[i]))
+    
+    def __iter__(self) -> Iterator[CompactGraph]:
+
+        for i in range(len(self)):
+            yield self[i]
+    
+    def range(self, start: int, end: int) -> Iterator[CompactGraph]:
+
+        for i in range(start, min(end, len(self))):
+            yield self[i]
+    
+    def __getstate__(self):
+        return self.store_path
+    
+    def __setstate__(self, store_path):
+        self.__init__(store_path)
+
+
+def open_store(source_path: str, dedupe: Optional[str] = 'exact') -> GraphStore:
+
+    # Reuse the compiled store when it was built from this exact revision
+    # of the source (size, mtime and inode), else build it. When the store cannot be written next to the source (a read-only
+    # dataset directory), it is built in a scratch directory instead and
+    # removed when the process exits.
+    if os.path.isdir(source_path) and os.path.exists(os.path.join(source_path, 'offsets.npy')):
+        return GraphStore(source_path)
+    
+    store_path = store_path_for(source_path, dedupe)
+    if read_stamp(store_path) != source_stamp(source_path):
+        try:
+            compile_store(source_path, store_path, dedupe)
+        except OSError as e:
+            if not os.path.exists(source_path):
+                raise
+            print(f"  Cannot write {store_path} ({e.strerror}), using a scratch store")
+            tmp_dir = scratch_dir()
+            atexit.register(shutil.rmtree, tmp_dir, True)
+            store_path = compile_store(source_path, os.path.join(tmp_dir, os.path.basename(store_path)), dedupe)
+    
+    return GraphStore(store_path)
+
+
+def scratch_dir() -> str:
+
+    # A fresh temporary directory, in shared memory when the platform has one.
+    return tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+
+@contextlib.contextmanager
+def shared_store(graphs: Iterable) -> Iterator[GraphStore]:
+
+    # graphs as a store that worker processes can map by path: a store is
+    # used as is, anything else goes through a scratch store removed on exit.
+    if isinstance(graphs, GraphStore):
+        yield graphs
+        return
+    
+    tmp_dir = scratch_dir()
+    try:
+        store_path = os.path.join(tmp_dir, 'graphs.store')
+        write_store(graphs, store_path)
+        yield GraphStore(store_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main():
+    if len(sys.argv) not in (2, 3, 4):
+        print("Usage: python graph_store.py <path_graph_dataset> [<path_store>] [exact|isomorphic]")
+        sys.exit(1)
+    
+    store_path = sys.argv[2] if len(sys.argv) >= 3 else None
+    dedupe = sys.argv[3] if len(sys.argv) == 4 else 'exact'
+    compile_store(sys.argv[1], store_path, dedupe)
+
+
+if __name__ == "__main__":
+    main()
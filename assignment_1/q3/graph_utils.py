@@ -2,8 +2,11 @@
 Graph utilities for parsing and handling graph datasets.
 """
 
+import hashlib
+from array import array
 import networkx as nx
-from typing import List, Tuple, Dict
+import numpy as np
+from typing import Any, List, Tuple, Dict, Iterable, Iterator
 
 
 class Graph:
@@ -36,71 +39,345 @@ class Graph:
         edges_str = ','.join(f"{src}-{dst}:{label}" for src, dst, label in sorted(self.edges))
         return f"N[{nodes_str}]E[{edges_str}]"
     
+    def exact_key(self) -> bytes:
+
+        # Digest of the same sorted nodes and edges as get_canonical_string,
+        # packed as int64s instead of formatted.
+        packed = array('q', [len(self.nodes)])
+        for item in sorted(self.nodes.items()):
+            packed.extend(item)
+        for edge in sorted(self.edges):
+            packed.extend(edge)
+        return hashlib.blake2b(packed, digest_size=16).digest()
+    
     def __eq__(self, other):
 
         if not isinstance(other, Graph):
             return False
-        return self.get_canonical_string() == other.get_canonical_string()
+        return self.exact_key() == other.exact_key()
     
     def __hash__(self):
 
-        return hash(self.get_canonical_string())
+        return hash(self.exact_key())
+    
+    def __getstate__(self):
+
+        # Cached backend structures are rebuilt on demand, never pickled.
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
 
 
-def parse_graph_file(filepath: str) -> List[Graph]:
+class CompactGraph:
 
-    graphs = []
-    current_graph = None
+    # Array-backed graph: node i has label node_labels[i] and neighbors
+    # indices[indptr[i]:indptr[i+1]] joined by the matching edge_labels.
+    # Everything lives in one int32 buffer; the named arrays are views.
+    __slots__ = ('data', 'n_nodes', 'graph_id')
+    
+    def __init__(self, data: np.ndarray, n_nodes: int, graph_id=None):
+        self.data = data
+        self.n_nodes = n_nodes
+        self.graph_id = graph_id
+    
+    @property
+    def node_labels(self) -> np.ndarray:
+        return self.data[:self.n_nodes]
+    
+    @property
+    def indptr(self) -> np.ndarray:
+        return self.data[self.n_nodes:2 * self.n_nodes + 1]
+    
+    @property
+    def degrees(self) -> np.ndarray:
+        return self.data[2 * self.n_nodes + 1:3 * self.n_nodes + 1]
+    
+    @property
+    def indices(self) -> np.ndarray:
+        start = 3 * self.n_nodes + 1
+        return self.data[start:start + self.n_slots]
+    
+    @property
+    def edge_labels(self) -> np.ndarray:
+        return self.data[3 * self.n_nodes + 1 + self.n_slots:]
+    
+    @property
+    def n_slots(self) -> int:
+        return (self.data.shape[0] - 3 * self.n_nodes - 1) // 2
+    
+    @classmethod
+    def from_arrays(cls, node_labels, src, dst, edge_labels, graph_id=None) -> 'CompactGraph':
+
+        n_nodes = len(node_labels)
+        src = np.asarray(src, dtype=np.int32)
+        dst = np.asarray(dst, dtype=np.int32)
+        edge_labels = np.asarray(edge_labels, dtype=np.int32)
+        
+
+        # Each undirected edge appears in both endpoints' rows; a stable
+        # sort keeps every row in edge order, matching to_networkx().
+        rows = np.stack([src, dst], axis=1).ravel()
+        cols = np.stack([dst, src], axis=1).ravel()
+        labels = np.repeat(edge_labels, 2)
+        order = np.argsort(rows, kind='stable')
+        
+        degrees = np.bincount(rows, minlength=n_nodes).astype(np.int32)
+        indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+        np.cumsum(degrees, out=indptr[1:])
+        
+        data = np.concatenate([
+            np.asarray(node_labels, dtype=np.int32), indptr, degrees,
+            cols[order], labels[order]
+        ])
+        return cls(data, n_nodes, graph_id)
+    
+    @classmethod
+    def from_graph(cls, graph: Graph) -> 'CompactGraph':
+
+        node_ids = sorted(graph.nodes)
+        position = {node_id: i for i, node_id in enumerate(node_ids)}
+        
+
+        # Parallel edges collapse to the last label, as in to_networkx().
+        edges = {}
+        for src, dst, label in graph.edges:
+            u, v = position[src], position[dst]
+            if u == v:
+                continue
+            edges[(u, v) if u < v else (v, u)] = label
+        
+
+        # Small graphs are built in plain Python; NumPy call overhead would
+        # dominate. Rows fill in edge order, as in from_arrays.
+        n_nodes = len(node_ids)
+        neighbors = [[] for _ in range(n_nodes)]
+        labels = [[] for _ in range(n_nodes)]
+        for (u, v), label in edges.items():
+            neighbors[u].append(v)
+            labels[u].append(label)
+            neighbors[v].append(u)
+            labels[v].append(label)
+        
+        data = array('i', [graph.nodes[node_id] for node_id in node_ids])
+        offset = 0
+        data.append(offset)
+        for row in neighbors:
+            offset += len(row)
+            data.append(offset)
+        data.extend(len(row) for row in neighbors)
+        for row in neighbors:
+            data.extend(row)
+        for row in labels:
+            data.extend(row)
+        
+        return cls(np.frombuffer(data, dtype=np.int32), n_nodes, graph.graph_id)
+    
+    def __getstate__(self):
+        return self.data.tobytes(), self.n_nodes, self.graph_id
+    
+    def __setstate__(self, state):
+        buffer, self.n_nodes, self.graph_id = state
+        self.data = np.frombuffer(buffer, dtype=np.int32)
+    
+    @property
+    def n_edges(self) -> int:
+        return self.n_slots // 2
+    
+    def neighbors(self, node: int) -> np.ndarray:
+
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+    
+    def edge_arrays(self):
+
+        # (src, dst, label) with src < dst, one entry per undirected edge.
+        rows = np.repeat(np.arange(self.n_nodes, dtype=np.int32), self.degrees)
+        keep = rows < self.indices
+        return rows[keep], self.indices[keep], self.edge_labels[keep]
+    
+    def adjacency(self) -> List[List[Tuple[int, int]]]:
+
+        # Plain-int (neighbor, edge_label) lists for tight Python loops.
+        indptr = self.indptr.tolist()
+        pairs = list(zip(self.indices.tolist(), self.edge_labels.tolist()))
+        return [pairs[indptr[i]:indptr[i + 1]] for i in range(self.n_nodes)]
+    
+    def to_graph(self) -> Graph:
+
+        g = Graph()
+        for node_id, label in enumerate(self.node_labels.tolist()):
+            g.add_node(node_id, label)
+        for src, dst, label in zip(*(a.tolist() for a in self.edge_arrays())):
+            g.add_edge(src, dst, label)
+        g.graph_id = self.graph_id
+        return g
+    
+    def to_rustworkx(self):
+
+        # Node indices are CSR positions, so no id map is needed.
+        import rustworkx as rx
+        G = rx.PyGraph()
+        G.add_nodes_from(self.node_labels.tolist())
+        G.extend_from_weighted_edge_list(list(zip(*(a.tolist() for a in self.edge_arrays()))))
+        return G
+    
+    def to_networkx(self) -> nx.Graph:
+
+        G = nx.Graph()
+        for node_id, label in enumerate(self.node_labels.tolist()):
+            G.add_node(node_id, label=label)
+        for src, dst, label in zip(*(a.tolist() for a in self.edge_arrays())):
+            G.add_edge(src, dst, label=label)
+        return G
+
+
+def as_compact(graph) -> CompactGraph:
+
+    return graph if isinstance(graph, CompactGraph) else CompactGraph.from_graph(graph)
+
+
+def label_adjacency(graph):
+
+    # (nodes, labels, adjacency) where labels[node] is the node label and
+    # adjacency[node] lists (neighbor, edge_label); accepts CompactGraph,
+    # Graph or nx.Graph.
+    if isinstance(graph, CompactGraph):
+        return range(graph.n_nodes), graph.node_labels.tolist(), graph.adjacency()
     
+    if isinstance(graph, Graph):
+        graph = graph.to_networkx()
+    
+    labels = {n: d.get('label', 0) for n, d in graph.nodes(data=True)}
+    adjacency = {
+        n: [(v, d.get('label', 0)) for v, d in nbrs.items()]
+        for n, nbrs in graph.adjacency()
+    }
+    return list(labels), labels, adjacency
+
+
+READ_BUFFER_SIZE = 1 << 22
+
+
+def _iter_lines(filepath: str, buffer_size: int = READ_BUFFER_SIZE) -> Iterator[str]:
+
     with open(filepath, 'r') as f:
-        for line in f:
-            line = line.strip()
-            
-            if line.startswith('#'):
+        tail = ''
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                break
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            yield from lines
+        if tail:
+            yield tail
 
-                if current_graph is not None and len(current_graph.nodes) > 0:
-                    graphs.append(current_graph)
 
-                    if len(graphs) % 50 == 0:
-                        print(f"  Parsed {len(graphs)} graphs...")
+def iter_graphs(filepath: str) -> Iterator[Graph]:
+
+    n_graphs = 0
+    current_graph = None
+    
+    for line in _iter_lines(filepath):
+        line = line.strip()
+        
+        # '#' separates graphs in the course format, 't # id' in .gspan.
+        if line.startswith('#') or line.startswith('t '):
+
+            if current_graph is not None and len(current_graph.nodes) > 0:
+                yield current_graph
+                n_graphs += 1
 
-                current_graph = Graph()
-                current_graph.graph_id = len(graphs)
-                
-            elif line.startswith('v '):
+            current_graph = Graph()
+            current_graph.graph_id = n_graphs
+            
+        elif line.startswith('v '):
 
-                parts = line.split()
-                node_id = int(parts[1])
-                label = int(parts[2])
-                current_graph.add_node(node_id, label)
-                
-            elif line.startswith('e '):
+            parts = line.split()
+            node_id = int(parts[1])
+            label = int(parts[2])
+            current_graph.add_node(node_id, label)
+            
+        elif line.startswith('e '):
 
-                parts = line.split()
-                src = int(parts[1])
-                dst = int(parts[2])
-                label = int(parts[3])
-                current_graph.add_edge(src, dst, label)
+            parts = line.split()
+            src = int(parts[1])
+            dst = int(parts[2])
+            label = int(parts[3])
+            current_graph.add_edge(src, dst, label)
     
 
     if current_graph is not None and len(current_graph.nodes) > 0:
-        graphs.append(current_graph)
-    
-    return graphs
+        yield current_graph
+
+
+def parse_graph_file(filepath: str) -> List[Graph]:
+
+    return list(iter_graphs(filepath))
+
+
+DEDUPE_MODES = ('exact', 'isomorphic')
+WL_ITERATIONS = 3
+
+
+def _same_label(a, b):
+    return a.get('label') == b.get('label')
 
 
-def remove_duplicates(graphs: List[Graph]) -> List[Graph]:
+def _class_representative(graph):
+
+    # CompactGraph drops self-loops, so graphs that have one are kept as-is.
+    if isinstance(graph, CompactGraph):
+        return graph
+    if any(src == dst for src, dst, _ in graph.edges):
+        return graph
+    return CompactGraph.from_graph(graph)
+
+
+def isomorphism_class(buckets: Dict[str, List], graph: Graph, value: Any = None) -> Tuple[Any, bool]:
+
+    # buckets maps a Weisfeiler-Lehman hash to (compact graph, value)
+    # pairs, one per isomorphism class; networkx graphs for a real
+    # isomorphism check are built only when the bucket is non-empty.
+    # Returns the value of the graph's class and True, or files the graph
+    # as a new class with value and returns (value, False).
+    G = graph.to_networkx()
+    wl_hash = nx.weisfeiler_lehman_graph_hash(
+        G, node_attr='label', edge_attr='label', iterations=WL_ITERATIONS
+    )
+    bucket = buckets.setdefault(wl_hash, [])
+    for other, other_value in bucket:
+        if nx.is_isomorphic(G, other.to_networkx(), node_match=_same_label, edge_match=_same_label):
+            return other_value, True
+    bucket.append((_class_representative(graph), value))
+    return value, False
+
+
+def iter_unique(graphs: Iterable[Graph], mode: str = 'exact') -> Iterator[Graph]:
+
+    # 'exact' drops graphs with identical node numbering, labels and edges;
+    # 'isomorphic' also drops relabelled copies. Only a digest per graph is
+    # kept for exact mode; isomorphic mode keeps one compact representative
+    # per class, keyed by Weisfeiler-Lehman hash, and runs a real
+    # isomorphism check only on hash collisions.
+    if mode not in DEDUPE_MODES:
+        raise ValueError(f"unknown dedupe mode {mode!r}, expected one of {DEDUPE_MODES}")
     
     seen = set()
-    unique_graphs = []
+    buckets = {}
     
     for graph in graphs:
-        canon = graph.get_canonical_string()
-        if canon not in seen:
-            seen.add(canon)
-            unique_graphs.append(graph)
+        key = graph.exact_key()
+        if key in seen:
+            continue
+        seen.add(key)
+        
+        if mode == 'isomorphic' and isomorphism_class(buckets, graph)[1]:
+            continue
+        
+        yield graph
+
+
+def remove_duplicates(graphs: List[Graph], mode: str = 'exact') -> List[Graph]:
     
-    return unique_graphs
+    return list(iter_unique(graphs, mode))
 
 
 def save_graphs(graphs: List[Graph], filepath: str):
@@ -1,8 +1,8 @@
 #!/bin/bash
 
 
-if [ "$#" -ne 2 ]; then
-    echo "Usage: bash identify.sh <path_graph_dataset> <path_discriminative_subgraphs>"
+if [ "$#" -ne 2 ] && { [ "$#" -ne 3 ] || [ "$3" != "--two-pass" ]; }; then
+    echo "Usage: bash identify.sh <path_graph_dataset> <path_discriminative_subgraphs> [--two-pass]"
     exit 1
 fi
 
@@ -11,4 +11,4 @@ OUTPUT_PATH=$2
 
 source venv/bin/activate
 
-python3 -u identify_subgraphs.py "$GRAPH_DATASET" "$OUTPUT_PATH"
+python3 -u identify_subgraphs.py ${3:+"$3"} "$GRAPH_DATASET" "$OUTPUT_PATH"
@@ -3,22 +3,33 @@ Main script for identifying discriminative subgraphs from database graphs.
 """
 
 import sys
-from graph_utils import parse_graph_file, remove_duplicates
+from graph_store import open_store
+from graph_utils import iter_graphs
 from fsm import select_discriminative_subgraphs, save_subgraphs
 
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python identify_subgraphs.py <path_graph_dataset> <path_discriminative_subgraphs>")
+    # --two-pass bounds mining memory with count-min sketches, see
+    # mine_frequent_paths.
+    two_pass = len(sys.argv) > 1 and sys.argv[1] == '--two-pass'
+    args = sys.argv[2:] if two_pass else sys.argv[1:]
+    
+    if (len(args) not in (2, 3, 4, 5) or (len(args) >= 3 and args[2] not in ('gaston', 'gspan'))
+            or (len(args) >= 4 and args[3] not in ('diverse', 'workload'))
+            or (len(args) == 5 and args[3] != 'workload')):
+        print("Usage: python identify_subgraphs.py [--two-pass] <path_graph_dataset> <path_discriminative_subgraphs> "
+              "[gaston|gspan] [diverse|workload [<path_query_graphs>]]")
         sys.exit(1)
     
-    input_path = sys.argv[1]
-    output_path = sys.argv[2]
+    input_path = args[0]
+    output_path = args[1]
+    miner = args[2] if len(args) >= 3 else 'gaston'
+    selection = args[3] if len(args) >= 4 else 'diverse'
     
-    graphs = parse_graph_file(input_path)
-
-
-    unique_graphs = remove_duplicates(graphs)
+    # Without a query file the workload is sampled from the dataset.
+    workload = list(iter_graphs(args[4])) if len(args) == 5 else None
+    
+    unique_graphs = open_store(input_path)
     
     k = 50  
     max_size = 9  
@@ -26,7 +37,11 @@ def main():
     discriminative_subgraphs = select_discriminative_subgraphs(
         unique_graphs,
         k=k,
-        max_size=max_size
+        max_size=max_size,
+        miner=miner,
+        two_pass=two_pass,
+        selection=selection,
+        workload=workload
     )
     
     save_subgraphs(discriminative_subgraphs, output_path)